@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+async_vehicle.py
+
+A vehicle whose drive loop runs on an asyncio event loop.
+"""
+
+import time
+import asyncio
+import inspect
+
+from .vehicle import Vehicle
+from .clock import LoopClock
+
+
+class AsyncVehicle(Vehicle):
+    """
+    Runs the drive loop as a coroutine so I/O bound parts can share one
+    event loop instead of each holding a thread.
+
+    * A threaded part with a coroutine method `update_async` runs it as a
+      task on the event loop. Other threaded parts keep their `update`
+      thread.
+    * A part with a coroutine method `run_async` is awaited in the drive
+      loop instead of calling `run`. The async parts of a stage (parts that
+      share no channels, see `Vehicle.add_to_stage`) are awaited together.
+      Parts added with `triggers` or `process` run outside the event loop
+      and use their `run` method; without one they can't be added.
+
+    Everything else works like `Vehicle`.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(AsyncVehicle, self).__init__(*args, **kwargs)
+        self.tasks = []
+
+
+    def add(self, part, *args, **kwargs):
+        options = inspect.signature(Vehicle.add).bind(self, part, *args, **kwargs).arguments
+        run_async = getattr(part, 'run_async', None)
+        is_async = run_async is not None and asyncio.iscoroutinefunction(run_async) \
+            and not options.get('threaded')
+        if is_async and (options.get('triggers') or options.get('process')):
+            #the trigger thread and the part process call run
+            if not hasattr(part, 'run'):
+                raise ValueError('{} has only run_async, it can not be added with triggers '
+                                 'or process'.format(part.__class__.__name__))
+            is_async = False
+
+        super(AsyncVehicle, self).add(part, *args, **kwargs)
+        if is_async:
+            record = self.records[-1]
+            record.run = run_async
+            record.is_async = True
+
+
+    def start(self, rate_hz=10, max_loop_count=None, ready_timeout=5.0):
+        """
+        Start the vehicle's drive loop on a new event loop. Takes the same
+        parameters as `Vehicle.start`.
+        """
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(self.drive(rate_hz, max_loop_count, ready_timeout))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+            for task in self.tasks:
+                task.cancel()
+            if self.tasks:
+                loop.run_until_complete(asyncio.gather(*self.tasks, return_exceptions=True))
+            self.tasks = []
+            loop.close()
+
+
+    async def drive(self, rate_hz, max_loop_count, ready_timeout):
+        self.on = True
+        self.set_part_rates(rate_hz)
+
+        for entry in self.parts:
+            thread = entry.get('thread')
+            if not thread:
+                continue
+            update_async = getattr(entry['part'], 'update_async', None)
+            if update_async is not None and asyncio.iscoroutinefunction(update_async):
+                self.tasks.append(asyncio.ensure_future(update_async()))
+            else:
+                thread.start()
+
+        self.start_triggered()
+
+        #wait until the parts warm up.
+        print('Starting vehicle...')
+        await self.wait_until_ready_async(ready_timeout)
+
+        loop_count = 0
+        tracer = self.tracer
+        if tracer is not None:
+            tracer.name_thread('drive loop')
+        self.clock = LoopClock(rate_hz)
+        self.clock.start()
+        self.register_metrics()
+        while self.on:
+            loop_count += 1
+
+            if tracer is not None:
+                t0 = tracer.clock()
+                await self.update_parts_async()
+                tracer.span('loop', 'vehicle', t0, tracer.clock(), {'loop': loop_count})
+            else:
+                await self.update_parts_async()
+
+            #stop drive loop if loop_count exceeds max_loopcount
+            if max_loop_count and loop_count > max_loop_count:
+                self.on = False
+
+            #always yield so the update tasks get to run
+            await asyncio.sleep(self.clock.time_left())
+            self.clock.tick()
+
+        self.raise_trigger_error()
+
+
+    async def wait_until_ready_async(self, timeout, poll_delay=0.01):
+        '''
+        Vehicle.wait_until_ready letting the update tasks run meanwhile
+        '''
+        start = time.monotonic()
+        waiting = self.parts_not_ready()
+        while waiting and time.monotonic() - start < timeout:
+            await asyncio.sleep(poll_delay)
+            waiting = self.parts_not_ready()
+
+        if waiting:
+            print('Parts not ready after {:.1f}s: {}'.format(timeout, ', '.join(waiting)))
+        return not waiting
+
+
+    async def update_parts_async(self):
+        '''
+        loop over all parts, stage by stage
+        '''
+        tick = self.tick
+        self.tick += 1
+        if self.profiler or self.tracer:
+            run_part = self.run_part_profiled
+        else:
+            run_part = self.run_part
+
+        for stage in self.stages:
+            pending = []
+            for record in stage:
+                if tick % record.every:
+                    continue
+                if record.is_async:
+                    pending.append(self.run_part_async(record))
+                else:
+                    run_part(record)
+            if pending:
+                await asyncio.gather(*pending)
+
+
+    async def run_part_async(self, record):
+        '''
+        run one async part: read its inputs, await it and save its outputs
+        '''
+        mem = self.mem
+
+        if record.condition_slot is not None and not mem.get_slot(record.condition_slot):
+            return
+
+        if record.skip_unchanged:
+            seqs = mem.get_seqs(record.input_slots)
+            if seqs == record.last_seqs:
+                return
+            record.last_seqs = seqs
+
+        t0 = time.perf_counter()
+        outputs = await record.run(*mem.get_slots(record.input_slots))
+        t1 = time.perf_counter()
+
+        if self.profiler:
+            self.profiler.record(record.name, 'run', t1 - t0)
+        if self.tracer:
+            #other tasks run while the part is awaited, the span covers both
+            self.tracer.span(record.name, 'part', t0, t1)
+
+        if outputs is not None:
+            if record.output_slot is not None:
+                mem.put_slot(record.output_slot, outputs)
+            elif record.output_slots:
+                mem.put_slots(record.output_slots, outputs)
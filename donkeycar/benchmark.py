@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+benchmark.py
+
+Measure how fast the vehicle drive loop runs the donkey2 part graph, built
+from mock parts so it runs on any computer.
+"""
+
+import gc
+import tempfile
+import tracemalloc
+
+import donkeycar as dk
+from donkeycar.parts.transform import Lambda
+from donkeycar.parts.camera import MockCamera
+from donkeycar.parts.ultrasonic import MockUltrasonic
+from donkeycar.parts.obstacle import Obstacle
+from donkeycar.parts.actuator import MockController, PWMSteering, PWMThrottle
+from donkeycar.parts.datastore import TubWriter
+
+
+class MockUserController:
+    '''
+    Stands in for the web controller: always returns the same user input.
+    '''
+    def __init__(self, mode='local', recording=False):
+        self.angle = 0.0
+        self.throttle = 0.0
+        self.mode = mode
+        self.recording = recording
+
+    def update(self):
+        pass
+
+    def run_threaded(self, *args):
+        return self.angle, self.throttle, self.mode, self.recording
+
+    def shutdown(self):
+        pass
+
+
+class MockPilot:
+    '''
+    Stands in for the keras pilot: a constant angle and throttle.
+    '''
+    def __init__(self, angle=0.1, throttle=0.3):
+        self.angle = angle
+        self.throttle = throttle
+
+    def update(self):
+        pass
+
+    def run_threaded(self, *args):
+        return self.angle, self.throttle
+
+    def shutdown(self):
+        pass
+
+
+def build_vehicle(vehicle=None, resolution=(160, 120), poll_delay=0.05,
+                  mode='local', recording=False, tub_path=None):
+    '''
+    Add the parts of the donkey2 drive template to a vehicle, the hardware
+    ones replaced by mocks. The tub is written to tub_path, or a temporary
+    directory, when recording is True.
+    '''
+    V = vehicle or dk.Vehicle()
+    ultrasonic_channels = ['ultrasonic_front/distance',
+                           'ultrasonic_front_left/distance',
+                           'ultrasonic_front_right/distance']
+
+    V.add(MockCamera(resolution=resolution),
+          outputs=['cam/image_array'], threaded=True)
+    for channel in ultrasonic_channels:
+        V.add(MockUltrasonic(poll_delay=poll_delay, name=channel.split('/')[0]),
+              outputs=[channel], threaded=True)
+
+    V.add(MockUserController(mode=mode, recording=recording),
+          inputs=['cam/image_array'] + ultrasonic_channels +
+                 ['pilot/action', 'pilot/angle', 'pilot/throttle'],
+          outputs=['user/angle', 'user/throttle', 'user/mode', 'recording'],
+          threaded=True)
+
+    def pilot_condition(mode):
+        return mode != 'user'
+
+    V.add(Lambda(pilot_condition), inputs=['user/mode'], outputs=['run_pilot'])
+
+    V.add(Obstacle(),
+          inputs=['cam/image_array'] + ultrasonic_channels,
+          outputs=['pilot/action'])
+
+    V.add(MockPilot(),
+          inputs=['cam/image_array'] + ultrasonic_channels + ['pilot/action'],
+          outputs=['pilot/angle', 'pilot/throttle'],
+          run_condition='run_pilot', threaded=True)
+
+    def drive_mode(mode, user_angle, user_throttle, pilot_angle, pilot_throttle):
+        if mode == 'user':
+            return user_angle, user_throttle
+        elif mode == 'local_angle':
+            return pilot_angle, user_throttle
+        else:
+            return pilot_angle, pilot_throttle
+
+    V.add(Lambda(drive_mode),
+          inputs=['user/mode', 'user/angle', 'user/throttle',
+                  'pilot/angle', 'pilot/throttle'],
+          outputs=['angle', 'throttle'])
+
+    V.add(PWMSteering(controller=MockController()), inputs=['angle'])
+    V.add(PWMThrottle(controller=MockController()), inputs=['throttle'])
+
+    inputs = ['cam/image_array'] + ultrasonic_channels + \
+             ['user/angle', 'user/throttle', 'user/mode']
+    types = ['image_array', 'float', 'float', 'float', 'float', 'float', 'str']
+    if recording and tub_path is None:
+        tub_path = tempfile.mkdtemp(prefix='donkey_benchmark_')
+    if tub_path is not None:
+        V.add(TubWriter(path=tub_path, inputs=inputs, types=types),
+              inputs=inputs, run_condition='recording')
+    return V
+
+
+def run_benchmark(loops=1000, allocations=True, parallel=False, **kwargs):
+    '''
+    Run the mock donkey2 vehicle unthrottled for a number of loops.
+
+    Returns a dict with the achieved loop rate, the per part statistics of
+    the profiler and, when allocations is True, the memory allocated by a
+    second run of the same number of loops traced with tracemalloc
+    (tracing slows the loop down, so it doesn't run with the timing).
+    '''
+    V = build_vehicle(dk.Vehicle(profile=True, parallel=parallel), **kwargs)
+    V.start(rate_hz=None, max_loop_count=loops)
+    loop_stats = V.loop_stats()
+
+    results = {'loops': loop_stats['ticks'],
+               'elapsed': loop_stats['elapsed'],
+               'rate_hz': loop_stats['rate_hz'],
+               'parts': V.profiler.stats()}
+
+    if allocations:
+        results['allocations'] = measure_allocations(loops, parallel=parallel, **kwargs)
+    return results
+
+
+def measure_allocations(loops, parallel=False, top=5, **kwargs):
+    '''
+    Net memory blocks and bytes allocated by the drive loop, the peak of
+    traced memory and the garbage collections, per loop, and the source
+    lines allocating the most.
+    '''
+    V = build_vehicle(dk.Vehicle(parallel=parallel), **kwargs)
+    #create the memory channels and warm up the parts
+    for _ in range(10):
+        V.update_parts()
+
+    collections = sum(s['collections'] for s in gc.get_stats())
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    if hasattr(tracemalloc, 'reset_peak'):
+        #python 3.9+, leave out the snapshot from the peak
+        tracemalloc.reset_peak()
+    for _ in range(loops):
+        V.update_parts()
+    after = tracemalloc.take_snapshot()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    collections = sum(s['collections'] for s in gc.get_stats()) - collections
+    V.stop()
+
+    filters = [tracemalloc.Filter(False, tracemalloc.__file__)]
+    diff = after.filter_traces(filters).compare_to(before.filter_traces(filters), 'lineno')
+    return {'blocks_per_loop': sum(d.count_diff for d in diff) / loops,
+            'bytes_per_loop': sum(d.size_diff for d in diff) / loops,
+            'peak_bytes': peak,
+            'gc_collections': collections,
+            'top': [str(d) for d in diff[:top]]}
+
+
+def format_report(results):
+    '''
+    returns the benchmark results as printable text
+    '''
+    lines = ['loops: {}  elapsed: {:.3f} s  rate: {:.1f} Hz  ({:.1f} us/loop)'.format(
+        results['loops'], results['elapsed'], results['rate_hz'],
+        results['elapsed'] / max(results['loops'], 1) * 1e6)]
+
+    header = '{:<24} {:>10} {:>10} {:>10}'
+    row = '{:<24} {:>10.1f} {:>10.1f} {:>10.1f}'
+    lines.append(header.format('part', 'p50 us', 'p99 us', 'max us'))
+    for name, phases in results['parts'].items():
+        if 'run' not in phases:
+            continue
+        st = phases['run']
+        lines.append(row.format(name[:24], st['p50'] * 1e6, st['p99'] * 1e6, st['max'] * 1e6))
+
+    alloc = results.get('allocations')
+    if alloc:
+        lines.append('allocations: {:.2f} blocks/loop  {:.1f} bytes/loop  peak {} bytes  '
+                     '{} gc collections'.format(alloc['blocks_per_loop'], alloc['bytes_per_loop'],
+                                                alloc['peak_bytes'], alloc['gc_collections']))
+        lines.extend(alloc['top'])
+    return '\n'.join(lines)
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+clock.py
+
+Timing of the vehicle drive loop.
+"""
+
+import math
+import time
+
+
+class LoopClock:
+    """
+    Keeps a loop running at a fixed rate.
+
+    Every tick has a deadline on a monotonic clock computed from the start
+    time, so sleeping a little too long on one tick doesn't push back the
+    following ones. A tick that ends after its deadline is an overrun; when
+    it runs over by more than a whole period, the missed ticks are skipped
+    instead of running back to back to catch up.
+
+    The lateness of every tick (how long after its scheduled time it
+    actually started) is kept as jitter statistics.
+
+    A rate_hz of None or 0 runs the loop as fast as it can, without
+    sleeping.
+    """
+
+    def __init__(self, rate_hz, clock=time.perf_counter, sleep=time.sleep):
+        self.period = 1.0 / rate_hz if rate_hz else 0.0
+        self.clock = clock
+        self.sleep = sleep
+        self.start_time = None
+        self.stop_time = None
+        self.deadline = None
+        self.ticks = 0
+        self.overruns = 0
+        self.skipped = 0
+        self.jitter_mean = 0.0
+        self.jitter_m2 = 0.0
+        self.jitter_max = 0.0
+
+    def start(self):
+        self.start_time = self.clock()
+        self.deadline = self.start_time + self.period
+
+    def stop(self):
+        '''
+        end the measured time of the loop
+        '''
+        self.stop_time = self.clock()
+
+    def wait(self):
+        '''
+        Sleep until the deadline of the current tick and schedule the next
+        one. Call this at the end of every loop.
+        '''
+        sleep_time = self.time_left()
+        if sleep_time > 0:
+            self.sleep(sleep_time)
+        self.tick()
+
+    def time_left(self):
+        '''
+        Seconds until the deadline of the current tick. When the deadline
+        has passed, count the overrun, skip the missed ticks and return 0.
+        '''
+        if self.deadline is None:
+            self.start()
+        if not self.period:
+            return 0.0
+
+        now = self.clock()
+        if now < self.deadline:
+            return self.deadline - now
+
+        self.overruns += 1
+        missed = int((now - self.deadline) // self.period)
+        if missed:
+            self.skipped += missed
+            self.deadline += missed * self.period
+        return 0.0
+
+    def tick(self):
+        '''
+        Close the current tick once its deadline is reached and schedule the
+        next one.
+        '''
+        if self.period:
+            self.add_jitter(max(0.0, self.clock() - self.deadline))
+        self.ticks += 1
+        self.deadline += self.period
+
+    def add_jitter(self, lateness):
+        #running mean and variance (Welford)
+        n = self.ticks + 1
+        delta = lateness - self.jitter_mean
+        self.jitter_mean += delta / n
+        self.jitter_m2 += delta * (lateness - self.jitter_mean)
+        if lateness > self.jitter_max:
+            self.jitter_max = lateness
+
+    def stats(self):
+        '''
+        returns the loop counters and jitter statistics, times in seconds.
+        The rate is measured until `stop` when it was called.
+        '''
+        if self.start_time is None:
+            elapsed = 0.0
+        elif self.stop_time is not None:
+            elapsed = self.stop_time - self.start_time
+        else:
+            elapsed = self.clock() - self.start_time
+        std = math.sqrt(self.jitter_m2 / self.ticks) if self.ticks else 0.0
+        return {'ticks': self.ticks,
+                'overruns': self.overruns,
+                'skipped': self.skipped,
+                'elapsed': elapsed,
+                'rate_hz': self.ticks / elapsed if elapsed > 0 else 0.0,
+                'jitter_mean': self.jitter_mean,
+                'jitter_std': std,
+                'jitter_max': self.jitter_max}
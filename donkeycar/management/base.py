@@ -294,6 +294,7 @@ class TubCheck(BaseCommand):
     def parse_args(self, args):
         parser = argparse.ArgumentParser(prog='tubcheck', usage='%(prog)s [options]')
         parser.add_argument('tubs', nargs='+', help='paths to tubs')
+        parser.add_argument('--fix', action='store_true', help='remove the records that fail to load')
         parsed_args = parser.parse_args(args)
         return parsed_args
 
@@ -309,7 +310,59 @@ class TubCheck(BaseCommand):
 
     def run(self, args):
         args = self.parse_args(args)
-        self.check(args.tubs)
+        self.check(args.tubs, fix=args.fix)
+
+
+class TubIndex(BaseCommand):
+    def parse_args(self, args):
+        parser = argparse.ArgumentParser(prog='tubindex', usage='%(prog)s [options]')
+        parser.add_argument('tubs', nargs='+', help='paths to tubs')
+        parsed_args = parser.parse_args(args)
+        return parsed_args
+
+    def run(self, args):
+        args = self.parse_args(args)
+        for tub_path in args.tubs:
+            tub = Tub(tub_path)
+            if tub.packed:
+                print('{} is packed, its writer keeps its index'.format(tub.path))
+            elif tub.create_manifest():
+                print('Wrote the manifest of {}'.format(tub.path))
+            else:
+                print('{} already has a manifest'.format(tub.path))
+
+
+class TubConvert(BaseCommand):
+    def parse_args(self, args):
+        parser = argparse.ArgumentParser(prog='tubconvert', usage='%(prog)s [options]')
+        parser.add_argument('tub', help='path of the tub to convert')
+        parser.add_argument('out', help='path of the new tub')
+        parser.add_argument('--format', default='packed', choices=['packed', 'files'],
+                            help='format of the new tub')
+        parsed_args = parser.parse_args(args)
+        return parsed_args
+
+    def run(self, args):
+        from donkeycar.parts.datastore import convert_tub
+        args = self.parse_args(args)
+        tub = convert_tub(args.tub, args.out, format=args.format)
+        print('Converted {} records to {}'.format(tub.get_num_records(), tub.path))
+
+
+class TubCacheCommand(BaseCommand):
+    def parse_args(self, args):
+        parser = argparse.ArgumentParser(prog='tubcache', usage='%(prog)s [options]')
+        parser.add_argument('tubs', nargs='+', help='paths to tubs')
+        parsed_args = parser.parse_args(args)
+        return parsed_args
+
+    def run(self, args):
+        from donkeycar.parts.datastore import Tub, TubCache
+        args = self.parse_args(args)
+        for tub_path in args.tubs:
+            cache = TubCache(Tub(tub_path))
+            count = cache.build()
+            print('Cached {} records in {}'.format(count, cache.path))
 
 
 class ShowHistogram(BaseCommand):
@@ -328,7 +381,7 @@ class ShowHistogram(BaseCommand):
         from matplotlib import pyplot as plt
         from donkeycar.parts.datastore import TubGroup
 
-        tg = TubGroup(tub_paths)
+        tg = TubGroup(tub_paths, workers=os.cpu_count())
         if record_name is not None:
             tg.df[record_name].hist(bins=50)
         else:
@@ -359,7 +412,7 @@ class ShowPredictionPlots(BaseCommand):
         model = KerasCategorical()
         model.load(model_path)
 
-        gen = tg.get_batch_gen(batch_size=len(tg.df),shuffle=False)
+        gen = tg.get_batch_gen(None, batch_size=len(tg.df), shuffle=False)
         arr = next(gen)
 
         """
@@ -401,6 +454,29 @@ class ShowPredictionPlots(BaseCommand):
         plt.show()
         """
 
+class Benchmark(BaseCommand):
+
+    def parse_args(self, args):
+        parser = argparse.ArgumentParser(prog='benchmark', usage='%(prog)s [options]')
+        parser.add_argument('--loops', type=int, default=1000, help='number of drive loops to run')
+        parser.add_argument('--parallel', action='store_true', help='run independent parts in parallel')
+        parser.add_argument('--record', action='store_true', help='write a tub to a temporary folder')
+        parser.add_argument('--no_alloc', action='store_true', help="don't trace memory allocations")
+        parsed_args = parser.parse_args(args)
+        return parsed_args
+
+    def run(self, args):
+        '''
+        Run the donkey2 drive loop with mock parts as fast as possible
+        and print the loop rate, the time of each part and the allocations.
+        '''
+        from donkeycar.benchmark import run_benchmark, format_report
+        args = self.parse_args(args)
+        results = run_benchmark(loops=args.loops, allocations=not args.no_alloc,
+                                parallel=args.parallel, recording=args.record)
+        print(format_report(results))
+
+
 def execute_from_command_line():
     """
     This is the fuction linked to the "donkey" terminal command.
@@ -413,8 +489,12 @@ def execute_from_command_line():
             'tubhist': ShowHistogram,
             'tubplot': ShowPredictionPlots,
             'tubcheck': TubCheck,
+            'tubindex': TubIndex,
+            'tubconvert': TubConvert,
+            'tubcache': TubCacheCommand,
             'makemovie': MakeMovie,
             'sim': Sim,
+            'benchmark': Benchmark,
                 }
     
     args = sys.argv[:]
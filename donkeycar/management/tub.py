@@ -7,6 +7,7 @@ Manage tubs
 import os, sys, time
 import json
 import tornado.web
+from donkeycar.parts.datastore import Tub
 from stat import S_ISREG, ST_MTIME, ST_MODE, ST_CTIME, ST_ATIME
 
 
@@ -110,6 +111,8 @@ class TubApi(tornado.web.RequestHandler):
         old_frames = list(itertools.chain(*old_clips))
         new_frames = list(itertools.chain(*new_clips['clips']))
         frames_to_delete = [str(item) for item in old_frames if item not in new_frames]
+        tub = Tub(tub_path)
         for frm in frames_to_delete:
-            os.remove(self.record_path(tub_path, frm))
+            tub.remove_record(int(frm))
             os.remove(self.image_path(tub_path, frm))
+        tub.shutdown()
@@ -6,21 +6,49 @@ Created on Sun Jun 25 11:07:48 2017
 @author: wroscoe
 """
 
+import time
+
+
 class Memory:
     """
     A convenience class to save key/value pairs.
+
+    Every channel also keeps a sequence number and the monotonic time of its
+    last change. Writing the object a channel already holds is not a change,
+    so a threaded part returning the same frame on every loop doesn't look
+    like new data.
     """
     def __init__(self, *args, **kw):
         self.d = {}
+        self.seqs = {}
+        self.stamps = {}
+        self.watchers = {}
+
+    def write(self, key, value):
+        d = self.d
+        if key not in d or d[key] is not value:
+            d[key] = value
+            self.seqs[key] = self.seqs.get(key, 0) + 1
+            self.stamps[key] = time.monotonic()
+            watchers = self.watchers.get(key)
+            if watchers:
+                for callback in watchers:
+                    callback()
+
+    def subscribe(self, slots, callback):
+        '''
+        call `callback` with no arguments after any of the channels changes
+        '''
+        for k in slots:
+            self.watchers.setdefault(k, []).append(callback)
     
     def __setitem__(self, key, value):
         if type(key) is not tuple:
-            print('tuples')
             key = (key,)
             value=(value,)
         
         for i, k in enumerate(key):
-            self.d[k] = value[i]
+            self.write(k, value[i])
         
     def __getitem__(self, key):
         if type(key) is tuple:
@@ -29,25 +57,37 @@ class Memory:
             return self.d[key]
         
     def update(self, new_d):
-        self.d.update(new_d)
+        for k, v in new_d.items():
+            self.write(k, v)
         
     def put(self, keys, inputs):
         if len(keys) > 1:
             for i, key in enumerate(keys):
                 try:
-                    self.d[key] = inputs[i]
+                    self.write(key, inputs[i])
                 except IndexError as e:
                     error = str(e) + ' issue with keys: ' + str(key)
                     raise IndexError(error)
         
         else:
-            self.d[keys[0]] = inputs
+            self.write(keys[0], inputs)
 
             
             
     def get(self, keys):
         result = [self.d.get(k) for k in keys]
         return result
+
+    def get_seq(self, key):
+        ''' number of changes of a channel, 0 if never written '''
+        return self.seqs.get(key, 0)
+
+    def age(self, key):
+        ''' seconds since the channel last changed, None if never written '''
+        stamp = self.stamps.get(key)
+        if stamp is None:
+            return None
+        return time.monotonic() - stamp
     
     def keys(self):
         return self.d.keys()
@@ -56,4 +96,143 @@ class Memory:
         return self.d.values()
     
     def iteritems(self):
-        return self.d.iteritems()
\ No newline at end of file
+        return self.d.iteritems()
+
+    '''
+    Slot API used by the vehicle drive loop. Channels are resolved to slots
+    once when a part is added, then read and written by slot on every tick.
+    The slots of this dict based memory are the channel names.
+    '''
+    def resolve(self, keys):
+        return tuple(keys)
+
+    def get_slot(self, slot):
+        return self.d.get(slot)
+
+    def get_slots(self, slots):
+        d = self.d
+        return [d.get(k) for k in slots]
+
+    def get_seqs(self, slots):
+        seqs = self.seqs
+        return tuple([seqs.get(k, 0) for k in slots])
+
+    def put_slot(self, slot, value):
+        self.write(slot, value)
+
+    def put_slots(self, slots, values):
+        if len(values) < len(slots):
+            raise IndexError('{} values for keys: {}'.format(len(values), slots))
+        for k, v in zip(slots, values):
+            self.write(k, v)
+
+
+class SlotMemory(Memory):
+    """
+    A memory that gives every channel a fixed integer slot in a list.
+
+    Slots are assigned the first time a channel is seen, usually when a part
+    is added to the vehicle, so the drive loop reads and writes by index
+    without hashing the channel names. The string API of Memory still works.
+    """
+    def __init__(self, *args, **kw):
+        self.slots = {}
+        self.data = []
+        self.slot_seqs = []
+        self.slot_stamps = []
+        self.slot_watchers = []
+
+    def slot(self, key):
+        slot = self.slots.get(key)
+        if slot is None:
+            slot = self.slots[key] = len(self.data)
+            self.data.append(None)
+            self.slot_seqs.append(0)
+            self.slot_stamps.append(None)
+            self.slot_watchers.append(None)
+        return slot
+
+    def write(self, key, value):
+        self.put_slot(self.slot(key), value)
+
+    def resolve(self, keys):
+        return tuple(self.slot(k) for k in keys)
+
+    def get_slot(self, slot):
+        return self.data[slot]
+
+    def get_slots(self, slots):
+        data = self.data
+        return [data[i] for i in slots]
+
+    def get_seqs(self, slots):
+        seqs = self.slot_seqs
+        return tuple([seqs[i] for i in slots])
+
+    def put_slot(self, slot, value):
+        data = self.data
+        if data[slot] is not value or self.slot_seqs[slot] == 0:
+            data[slot] = value
+            self.slot_seqs[slot] += 1
+            self.slot_stamps[slot] = time.monotonic()
+            watchers = self.slot_watchers[slot]
+            if watchers:
+                for callback in watchers:
+                    callback()
+
+    def subscribe(self, slots, callback):
+        for i in slots:
+            if self.slot_watchers[i] is None:
+                self.slot_watchers[i] = []
+            self.slot_watchers[i].append(callback)
+
+    def put_slots(self, slots, values):
+        if len(values) < len(slots):
+            raise IndexError('{} values for slots: {}'.format(len(values), slots))
+        put_slot = self.put_slot
+        for i, v in zip(slots, values):
+            put_slot(i, v)
+
+    def get_seq(self, key):
+        slot = self.slots.get(key)
+        return 0 if slot is None else self.slot_seqs[slot]
+
+    def age(self, key):
+        slot = self.slots.get(key)
+        if slot is None or self.slot_stamps[slot] is None:
+            return None
+        return time.monotonic() - self.slot_stamps[slot]
+
+    @property
+    def d(self):
+        ''' a dict copy of the channels, for reading only '''
+        return {k: self.data[i] for k, i in self.slots.items()}
+
+    @property
+    def seqs(self):
+        return {k: self.slot_seqs[i] for k, i in self.slots.items()}
+
+    @property
+    def stamps(self):
+        return {k: self.slot_stamps[i] for k, i in self.slots.items()
+                if self.slot_stamps[i] is not None}
+
+    def __getitem__(self, key):
+        if type(key) is tuple:
+            return [self.data[self.slots[k]] for k in key]
+        else:
+            return self.data[self.slots[key]]
+
+    def get(self, keys):
+        data = self.data
+        slots = self.slots
+        return [data[slots[k]] if k in slots else None for k in keys]
+
+    def keys(self):
+        return self.slots.keys()
+
+    def values(self):
+        return list(self.data)
+
+    def iteritems(self):
+        return iter(self.d.items())
@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+metrics.py
+
+Counters, gauges and histograms the parts update while the car drives,
+served in the Prometheus text format by the web controller at /metrics.
+"""
+
+import bisect
+import threading
+
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if value == float('-inf'):
+        return '-Inf'
+    return repr(float(value))
+
+
+def format_labels(labels, extra=None):
+    items = list(labels) + ([extra] if extra else [])
+    if not items:
+        return ''
+    escaped = ('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')
+                                          .replace('\n', '\\n'))
+               for k, v in items)
+    return '{' + ','.join(escaped) + '}'
+
+
+class Metric:
+    '''
+    A named value with a fixed set of labels. Instead of updating it, a
+    function returning the current value can be given with `set_function`,
+    it is called when the metrics are collected.
+    '''
+    kind = 'untyped'
+
+    def __init__(self, name, labels=()):
+        self.name = name
+        self.labels = labels
+        self.lock = threading.Lock()
+        self.value = 0.0
+        self.function = None
+
+    def set_function(self, function):
+        self.function = function
+
+    def get(self):
+        if self.function is not None:
+            return self.function()
+        return self.value
+
+    def samples(self):
+        yield self.name, self.labels, None, self.get()
+
+
+class Counter(Metric):
+    '''
+    A value that only goes up: frames, records, timeouts.
+    '''
+    kind = 'counter'
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+
+class Gauge(Metric):
+    '''
+    A value that goes up and down: a queue depth, a loop rate.
+    '''
+    kind = 'gauge'
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        with self.lock:
+            self.value -= amount
+
+
+class Histogram(Metric):
+    '''
+    Counts observations, like durations in seconds, in buckets given by
+    their upper bounds, and keeps their sum and count.
+    '''
+    kind = 'histogram'
+
+    def __init__(self, name, labels=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, labels)
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    def samples(self):
+        with self.lock:
+            counts = list(self.counts)
+            total, count = self.sum, self.count
+        cumulative = 0
+        for bound, n in zip(self.buckets + (float('inf'),), counts):
+            cumulative += n
+            yield self.name + '_bucket', self.labels, ('le', format_value(bound)), cumulative
+        yield self.name + '_sum', self.labels, None, total
+        yield self.name + '_count', self.labels, None, count
+
+
+class Registry:
+    '''
+    The metrics of a process. Asking twice for a metric with the same name
+    and labels returns the same object, so parts can create their metrics
+    in their constructor.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+        self.helps = {}
+        self.kinds = {}
+
+    def get_or_create(self, cls, name, help, labels, **kwargs):
+        labels = tuple(sorted((labels or {}).items()))
+        key = (name, labels)
+        with self.lock:
+            metric = self.metrics.get(key)
+            if metric is None:
+                if self.kinds.setdefault(name, cls.kind) != cls.kind:
+                    raise ValueError('metric {} is a {}'.format(name, self.kinds[name]))
+                metric = self.metrics[key] = cls(name, labels, **kwargs)
+                if help:
+                    self.helps[name] = help
+            return metric
+
+    def counter(self, name, help='', labels=None):
+        return self.get_or_create(Counter, name, help, labels)
+
+    def gauge(self, name, help='', labels=None):
+        return self.get_or_create(Gauge, name, help, labels)
+
+    def histogram(self, name, help='', labels=None, buckets=DEFAULT_BUCKETS):
+        return self.get_or_create(Histogram, name, help, labels, buckets=buckets)
+
+    def render(self):
+        '''
+        all the metrics in the Prometheus text exposition format
+        '''
+        with self.lock:
+            metrics = sorted(self.metrics.values(), key=lambda m: (m.name, m.labels))
+        lines = []
+        name = None
+        for metric in metrics:
+            if metric.name != name:
+                name = metric.name
+                if name in self.helps:
+                    lines.append('# HELP {} {}'.format(name, self.helps[name]))
+                lines.append('# TYPE {} {}'.format(name, metric.kind))
+            for sample, labels, extra, value in metric.samples():
+                lines.append('{}{} {}'.format(sample, format_labels(labels, extra),
+                                              format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def counter(name, help='', labels=None):
+    return REGISTRY.counter(name, help, labels)
+
+
+def gauge(name, help='', labels=None):
+    return REGISTRY.gauge(name, help, labels)
+
+
+def histogram(name, help='', labels=None, buckets=DEFAULT_BUCKETS):
+    return REGISTRY.histogram(name, help, labels, buckets)
+
+
+def render():
+    return REGISTRY.render()
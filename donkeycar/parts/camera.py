@@ -3,12 +3,17 @@ import time
 import numpy as np
 from PIL import Image
 import glob
+from donkeycar import metrics
 
 class BaseCamera:
 
     def run_threaded(self):
         return self.frame
 
+    def ready(self):
+        ''' a camera is ready once it captured its first frame '''
+        return self.frame is not None
+
 class PiCamera(BaseCamera):
     def __init__(self, resolution=(120, 160), framerate=20, name = ''):
 
@@ -32,15 +37,17 @@ class PiCamera(BaseCamera):
         # if the thread should be stopped
         self.frame = None
         self.on = True
+        self.frames = metrics.counter('donkey_camera_frames_total',
+                                      'Frames captured by the camera', {'camera': name})
 
-        print('PiCamera loaded.. .warming camera')
-        time.sleep(2)
+        print('PiCamera loaded.')
 
 
     def run(self):
         f = next(self.stream)
         frame = f.array
         self.rawCapture.truncate(0)
+        self.frames.inc()
         return frame
 
     def update(self):
@@ -50,6 +57,7 @@ class PiCamera(BaseCamera):
             # preparation for the next frame
             self.frame = f.array
             self.rawCapture.truncate(0)
+            self.frames.inc()
 
             # if the thread indicator variable is set, stop the thread
             if not self.on:
@@ -85,10 +93,10 @@ class Webcam(BaseCamera):
         # if the thread should be stopped
         self.frame = None
         self.on = True
+        self.frames = metrics.counter('donkey_camera_frames_total',
+                                      'Frames captured by the camera', {'camera': name})
 
-        print('WebcamVideoStream loaded.. .warming camera')
-
-        time.sleep(2)
+        print('WebcamVideoStream loaded.')
 
     def update(self):
         from datetime import datetime, timedelta
@@ -102,6 +110,7 @@ class Webcam(BaseCamera):
                 snapshot = self.cam.get_image()
                 snapshot1 = pygame.transform.scale(snapshot, self.resolution)
                 self.frame = pygame.surfarray.pixels3d(pygame.transform.rotate(pygame.transform.flip(snapshot1, True, False), 90))
+                self.frames.inc()
 
             stop = datetime.now()
             s = 1 / self.framerate - (stop - start).total_seconds()
@@ -171,6 +180,10 @@ class ImageListCamera(BaseCamera):
 
         return np.asarray(self.frame)
 
+    def ready(self):
+        ''' frames are read from disk when asked for '''
+        return self.num_images > 0
+
     def shutdown(self):
         pass
 
@@ -5,18 +5,48 @@ Created on Tue Jul  4 12:32:53 2017
 
 @author: wroscoe
 """
+import io
 import os
 import sys
 import time
 import json
+import struct
 import datetime
 import random
 import glob
+import pickle
+import queue
+import threading
+import collections
+import multiprocessing
+import multiprocessing.pool
+import concurrent.futures
 import numpy as np
 import pandas as pd
 
 from PIL import Image
 from donkeycar import utils
+from donkeycar import metrics
+
+
+MANIFEST_FILE = 'manifest.txt'
+
+#files of the packed tub format
+PACKED_LOG_FILE = 'records.jsonl'
+PACKED_INDEX_FILE = 'records.idx'
+PACKED_BLOB_FILE = 'images.bin'
+#record index, offset and length of its line in the log
+PACKED_INDEX_ENTRY = struct.Struct('<qqq')
+
+#directory of the decoded image cache in a tub
+CACHE_DIR = 'cache'
+#parsed records of a tub, in its cache directory
+DF_CACHE_FILE = 'records.pkl'
+
+TUB_RECORDS = metrics.counter('donkey_tub_records_total', 'Records written to tubs')
+TUB_WRITE_SECONDS = metrics.histogram('donkey_tub_write_seconds', 'Time to write a tub record')
+TUB_QUEUE_DEPTH = metrics.gauge('donkey_tub_queue_depth', 'Records waiting to be written to the tub')
+TUB_DROPPED = metrics.counter('donkey_tub_records_dropped_total', 'Records dropped with a full tub queue')
 
 
 class OriginalWriter:
@@ -133,12 +163,32 @@ class OriginalWriter:
 
 
 
+def read_blob(path, offset, length):
+    '''
+    bytes of an image saved in the blob file of a packed tub
+    '''
+    with open(path, 'rb') as fp:
+        fp.seek(offset)
+        return fp.read(length)
+
+
 class Tub(object):
     """
     A datastore to store sensor data in a key, value format.
 
     Accepts str, int, float, image_array, image, and array data types.
 
+    The indexes of the records are listed in an append-only manifest file,
+    one per line (a line '-N' removes record N), so opening a tub doesn't
+    list its directory. A missing or corrupt manifest is rebuilt from the
+    record files.
+
+    A tub created with format='packed' instead appends all its records to
+    one log file, one json line per record, and the jpeg encoded images to
+    one blob file, so writing and reading are sequential. An index file
+    holds the offset of every record in the log. The format is saved in
+    the meta, see `convert_tub` to convert a tub.
+
     For example:
 
     #Create a tub to store speed values.
@@ -149,11 +199,22 @@ class Tub(object):
 
     """
 
-    def __init__(self, path, inputs=None, types=None):
+    def __init__(self, path, inputs=None, types=None, format='files'):
 
         self.path = os.path.expanduser(path)
         print('path_in_tub:', self.path)
         self.meta_path = os.path.join(self.path, 'meta.json')
+        self.manifest_path = os.path.join(self.path, MANIFEST_FILE)
+        self.manifest_fp = None
+        self.packed_log_path = os.path.join(self.path, PACKED_LOG_FILE)
+        self.packed_index_path = os.path.join(self.path, PACKED_INDEX_FILE)
+        self.packed_blob_path = os.path.join(self.path, PACKED_BLOB_FILE)
+        self.packed_fps = None
+        self.packed_offsets = {}
+        self.packed_index_size = 0
+        self.packed_log_size = 0
+        self.packed_blob_size = 0
+        self.deferred_flush = False
         self.df = None
 
         exists = os.path.exists(self.path)
@@ -170,8 +231,15 @@ class Tub(object):
             #create log and save meta
             os.makedirs(self.path)
             self.meta = {'inputs': inputs, 'types': types}
+            if format != 'files':
+                self.meta['format'] = format
             with open(self.meta_path, 'w') as f:
                 json.dump(self.meta, f)
+            if self.packed:
+                for path in (self.packed_log_path, self.packed_index_path, self.packed_blob_path):
+                    open(path, 'wb').close()
+            else:
+                open(self.manifest_path, 'w').close()
             self.current_ix = 0
             print('New tub created at: {}'.format(self.path))
         else:
@@ -184,12 +252,74 @@ class Tub(object):
 
 
     def get_last_ix(self):
-        index = self.get_index()
-        return max(index)
+        index = self.get_index(shuffled=False)
+        return index[-1] if index else 0
 
-    def update_df(self):
-        df = pd.DataFrame([self.get_json_record(i) for i in self.get_index(shuffled=False)])
-        self.df = df
+    def update_df(self, use_cache=True):
+        '''
+        Load the records into self.df. The parsed records are saved in the
+        cache directory of the tub with its signature; when the tub changed
+        since, only the records added are parsed.
+        '''
+        index = self.get_index(shuffled=False)
+        cached = self.read_df_cache() if use_cache else None
+        if cached is not None and cached['signature'] == self.signature():
+            self.df = cached['df'].reset_index(drop=True)
+            return
+
+        #the cached df is indexed by record index
+        df = cached['df'] if cached is not None else pd.DataFrame()
+        parsed = set(df.index)
+        records = []
+        record_ixs = []
+        missing = False
+        for i in index:
+            if i in parsed:
+                continue
+            try:
+                records.append(self.get_json_record(i))
+                record_ixs.append(i)
+            except FileNotFoundError:
+                missing = True
+        if missing:
+            #records were removed without updating the manifest
+            print('Tub manifest lists missing records, skipping them. Fix it with '
+                  '`donkey tubcheck --fix`: {}'.format(self.path))
+
+        if records:
+            new_df = pd.DataFrame(records, index=record_ixs)
+            df = pd.concat([df, new_df], sort=False) if len(df) else new_df
+        #drop the removed records, in index order
+        present = set(df.index)
+        df = df.loc[[i for i in index if i in present]]
+        if use_cache:
+            self.write_df_cache(df)
+        self.df = df.reset_index(drop=True)
+
+    def read_df_cache(self):
+        try:
+            with open(os.path.join(self.path, CACHE_DIR, DF_CACHE_FILE), 'rb') as fp:
+                cached = pickle.load(fp)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            print('Ignoring the unreadable records cache of {}: {}'.format(self.path, e))
+            return None
+        #paths in the records are absolute
+        if cached.get('path') != self.path:
+            return None
+        return cached
+
+    def write_df_cache(self, df):
+        path = os.path.join(self.path, CACHE_DIR, DF_CACHE_FILE)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path + '.tmp', 'wb') as fp:
+                pickle.dump({'signature': self.signature(), 'path': self.path, 'df': df}, fp,
+                            protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(path + '.tmp', path)
+        except OSError as e:
+            print('Could not save the records cache of {}: {}'.format(self.path, e))
 
     def get_df(self):
         if self.df is None:
@@ -197,7 +327,272 @@ class Tub(object):
         return self.df
 
 
+    @property
+    def packed(self):
+        return self.meta.get('format') == 'packed'
+
     def get_index(self, shuffled=True):
+        if self.packed:
+            nums = sorted(self.get_packed_index())
+        else:
+            nums = self.read_manifest()
+            if nums is None:
+                #a writer may have the manifest open, only writers rebuild it
+                nums = self.scan_index()
+
+        if shuffled:
+            random.shuffle(nums)
+
+        return nums
+
+
+    def read_manifest(self):
+        '''
+        sorted record indexes of the manifest, None if it is missing or corrupt
+        '''
+        try:
+            with open(self.manifest_path, 'r') as fp:
+                text = fp.read()
+        except FileNotFoundError:
+            return None
+
+        #a write interrupted in the middle of a line
+        if text and not text.endswith('\n'):
+            return None
+
+        index = set()
+        try:
+            for line in text.splitlines():
+                if line.startswith('-'):
+                    index.discard(int(line[1:]))
+                else:
+                    index.add(int(line))
+        except ValueError:
+            return None
+        return sorted(index)
+
+
+    def rebuild_manifest(self):
+        '''
+        Write the manifest from the record files of the tub directory. The
+        file is replaced, so only the process writing the tub may call this:
+        another writer would keep appending to the old file.
+        '''
+        nums = self.scan_index()
+        if self.manifest_fp is not None:
+            self.manifest_fp.close()
+            self.manifest_fp = None
+        tmp_path = self.manifest_path + '.tmp'
+        try:
+            with open(tmp_path, 'w') as fp:
+                fp.write(''.join('{}\n'.format(ix) for ix in nums))
+            os.replace(tmp_path, self.manifest_path)
+        except OSError as e:
+            print('Could not write the tub manifest:', e)
+        return nums
+
+
+    def create_manifest(self):
+        '''
+        Write the manifest of a tub that has none (recorded before manifests
+        existed) from the record files of its directory, so readers stop
+        listing it. An existing manifest is never replaced, a writer may have
+        it open: the file is written aside and linked in place only when the
+        name is free. Returns True when the manifest was created.
+        '''
+        nums = self.scan_index()
+        tmp_path = '{}.{}.tmp'.format(self.manifest_path, os.getpid())
+        with open(tmp_path, 'w') as fp:
+            fp.write(''.join('{}\n'.format(ix) for ix in nums))
+        try:
+            os.link(tmp_path, self.manifest_path)
+        except FileExistsError:
+            return False
+        finally:
+            os.remove(tmp_path)
+        return True
+
+
+    def open_manifest(self):
+        '''
+        the manifest opened for appending, rebuilt first when it is missing
+        or corrupt: this is the process writing the tub
+        '''
+        if self.manifest_fp is None:
+            if self.read_manifest() is None:
+                self.rebuild_manifest()
+            #line buffered, every record is flushed once written
+            self.manifest_fp = open(self.manifest_path, 'a', buffering=1)
+        return self.manifest_fp
+
+    def append_manifest(self, line):
+        self.open_manifest().write(line + '\n')
+
+
+    def get_packed_index(self):
+        '''
+        record index -> (offset, length) of its line in the log of a packed
+        tub. Only the entries added since the last call are read. A missing
+        or truncated index is not rewritten here, the offsets are read from
+        the log instead; the writer rebuilds it, see `open_packed`.
+        '''
+        try:
+            size = os.path.getsize(self.packed_index_path)
+        except FileNotFoundError:
+            size = None
+        if size is None or size < self.packed_index_size:
+            offsets, _ = self.scan_packed_log()
+            self.packed_offsets = offsets
+            self.packed_index_size = 0
+            return offsets
+
+        #an entry being written, read it next time
+        size -= size % PACKED_INDEX_ENTRY.size
+        if size > self.packed_index_size:
+            with open(self.packed_index_path, 'rb') as fp:
+                fp.seek(self.packed_index_size)
+                data = fp.read(size - self.packed_index_size)
+            for ix, offset, length in PACKED_INDEX_ENTRY.iter_unpack(data):
+                if offset < 0:
+                    self.packed_offsets.pop(ix, None)
+                else:
+                    self.packed_offsets[ix] = (offset, length)
+            self.packed_index_size = size
+        return self.packed_offsets
+
+
+    def scan_packed_log(self):
+        '''
+        the offsets of the records and the index entries read from the log
+        of a packed tub
+        '''
+        offsets = {}
+        entries = []
+        offset = 0
+        with open(self.packed_log_path, 'rb') as fp:
+            for line in fp:
+                try:
+                    if not line.endswith(b'\n'):
+                        raise ValueError('incomplete line')
+                    if line.startswith(b'-'):
+                        ix = int(line[1:])
+                        offsets.pop(ix, None)
+                        entries.append((ix, -1, 0))
+                    else:
+                        ix = int(line.split(b'\t', 1)[0])
+                        offsets[ix] = (offset, len(line))
+                        entries.append((ix, offset, len(line)))
+                except ValueError:
+                    print('Skipping a damaged line of the tub log at {}'.format(offset))
+                offset += len(line)
+        return offsets, entries
+
+
+    def rebuild_packed_index(self):
+        '''
+        Write the index of a packed tub from its log. The file is replaced,
+        so only the process writing the tub may call this.
+        '''
+        print('Rebuilding the index of packed tub: {}'.format(self.path))
+        offsets, entries = self.scan_packed_log()
+        data = b''.join(PACKED_INDEX_ENTRY.pack(*e) for e in entries)
+        tmp_path = self.packed_index_path + '.tmp'
+        with open(tmp_path, 'wb') as fp:
+            fp.write(data)
+        os.replace(tmp_path, self.packed_index_path)
+        self.packed_offsets = offsets
+        self.packed_index_size = len(data)
+        return offsets
+
+
+    def open_packed(self):
+        '''
+        the log, index and blob files of a packed tub opened for appending
+        '''
+        if self.packed_fps is None:
+            try:
+                size = os.path.getsize(self.packed_index_path)
+            except FileNotFoundError:
+                size = None
+            if size is None or size % PACKED_INDEX_ENTRY.size:
+                #missing, or an entry cut by an interrupted write
+                self.rebuild_packed_index()
+            else:
+                self.get_packed_index()
+            log_fp = open(self.packed_log_path, 'ab')
+            if log_fp.tell():
+                with open(self.packed_log_path, 'rb') as fp:
+                    fp.seek(-1, os.SEEK_END)
+                    if fp.read(1) != b'\n':
+                        #end the line of an interrupted write
+                        log_fp.write(b'\n')
+            index_fp = open(self.packed_index_path, 'ab')
+            blob_fp = open(self.packed_blob_path, 'ab')
+            self.packed_log_size = log_fp.tell()
+            self.packed_blob_size = blob_fp.tell()
+            self.packed_fps = (log_fp, index_fp, blob_fp)
+        return self.packed_fps
+
+
+    def append_blob(self, data):
+        '''
+        append encoded image bytes to the blob of a packed tub, returns
+        their [offset, length]
+        '''
+        blob_fp = self.open_packed()[2]
+        offset = self.packed_blob_size
+        blob_fp.write(data)
+        if not self.deferred_flush:
+            blob_fp.flush()
+        self.packed_blob_size += len(data)
+        return [offset, len(data)]
+
+
+    def append_packed_record(self, ix, json_data):
+        '''
+        append a record to the log of a packed tub and its offset to the
+        index. json_data None appends the removal of the record.
+        '''
+        log_fp, index_fp, _ = self.open_packed()
+        if json_data is None:
+            line = '-{}\n'.format(ix).encode()
+            entry = (ix, -1, 0)
+        else:
+            line = '{}\t{}\n'.format(ix, json.dumps(json_data)).encode()
+            entry = (ix, self.packed_log_size, len(line))
+
+        log_fp.write(line)
+        index_fp.write(PACKED_INDEX_ENTRY.pack(*entry))
+        if not self.deferred_flush:
+            log_fp.flush()
+            index_fp.flush()
+
+        self.packed_log_size += len(line)
+        self.packed_index_size += PACKED_INDEX_ENTRY.size
+        if json_data is None:
+            self.packed_offsets.pop(ix, None)
+        else:
+            self.packed_offsets[ix] = entry[1:]
+
+
+    def flush(self):
+        '''
+        write out the records buffered while deferred_flush was set
+        '''
+        if self.packed_fps is not None:
+            log_fp, index_fp, blob_fp = self.packed_fps
+            #in this order, so the index never points past the log or blob
+            blob_fp.flush()
+            log_fp.flush()
+            index_fp.flush()
+        if self.manifest_fp is not None:
+            self.manifest_fp.flush()
+
+
+    def scan_index(self):
+        '''
+        sorted record indexes found in the tub directory
+        '''
         files = next(os.walk(self.path))[2]
         record_files = [f for f in files if f[:6]=='record']
         
@@ -210,13 +605,7 @@ class Tub(object):
             return num
 
         nums = [get_file_ix(f) for f in record_files]
-        
-        if shuffled:
-            random.shuffle(nums)
-        else:
-            nums = sorted(nums)
-            
-        return nums 
+        return sorted(nums)
 
 
     @property
@@ -246,9 +635,23 @@ class Tub(object):
             raise
 
     def get_num_records(self):
-        import glob
-        files = glob.glob(os.path.join(self.path, 'record_*.json'))
-        return len(files)
+        return len(self.get_index(shuffled=False))
+
+    def signature(self):
+        '''
+        size and modification time of the file listing the records, they
+        change whenever a record is added or removed. Without that file,
+        those of the log of a packed tub or of the tub directory.
+        '''
+        if self.packed:
+            paths = (self.packed_index_path, self.packed_log_path)
+        else:
+            paths = (self.manifest_path, self.path)
+        try:
+            st = os.stat(paths[0])
+        except FileNotFoundError:
+            st = os.stat(paths[1])
+        return [st.st_size, st.st_mtime_ns]
 
 
 
@@ -260,6 +663,9 @@ class Tub(object):
             if type(v) == str: #filename
                 if '.' in v:
                     v = os.path.join(self.path, v)
+            elif type(v) == list and self.packed and self.get_input_type(k) == 'image_array':
+                #offset and length in the blob of a packed tub
+                v = (self.packed_blob_path, v[0], v[1])
             d[k] = v
 
         return d
@@ -292,8 +698,15 @@ class Tub(object):
         '''
         remove data associate with a record
         '''
+        if self.packed:
+            self.append_packed_record(ix, None)
+            return
         record = self.get_json_record_path(ix)
-        os.unlink(record)
+        try:
+            os.unlink(record)
+        except FileNotFoundError:
+            pass
+        self.append_manifest('-{}'.format(ix))
 
     def put_record(self, data):
         """
@@ -301,6 +714,7 @@ class Tub(object):
         return a record with references to the saved values that can
         be saved in a csv.
         """
+        start = time.perf_counter()
         json_data = {}
         self.current_ix += 1
         
@@ -317,22 +731,62 @@ class Tub(object):
 
             elif typ == 'image_array':
                 img = Image.fromarray(np.uint8(val))
-                name = self.make_file_name(key, ext='.jpg')
-                img.save(os.path.join(self.path, name))
-                json_data[key]=name
+                if self.packed:
+                    buf = io.BytesIO()
+                    img.save(buf, format='jpeg')
+                    json_data[key] = self.append_blob(buf.getvalue())
+                else:
+                    name = self.make_file_name(key, ext='.jpg')
+                    img.save(os.path.join(self.path, name))
+                    json_data[key]=name
 
             else:
                 msg = 'Tub does not know what to do with this type {}'.format(typ)
                 raise TypeError(msg)
 
-        self.write_json_record(json_data)
+        self.save_json_record(json_data)
+        TUB_WRITE_SECONDS.observe(time.perf_counter() - start)
+        TUB_RECORDS.inc()
         return self.current_ix
 
 
+    def put_encoded_record(self, ix, data):
+        '''
+        Save a record under the index ix, with its image_array values
+        already encoded as jpeg bytes.
+        '''
+        self.current_ix = ix
+        json_data = {}
+        for key, val in data.items():
+            if self.get_input_type(key) != 'image_array':
+                json_data[key] = val
+            elif self.packed:
+                json_data[key] = self.append_blob(val)
+            else:
+                name = self.make_file_name(key, ext='.jpg')
+                with open(os.path.join(self.path, name), 'wb') as fp:
+                    fp.write(val)
+                json_data[key] = name
+        self.save_json_record(json_data)
+
+
+    def save_json_record(self, json_data):
+        if self.packed:
+            self.append_packed_record(self.current_ix, json_data)
+        else:
+            #before the record file, a rebuild would list it already
+            self.open_manifest()
+            self.write_json_record(json_data)
+            self.append_manifest(str(self.current_ix))
+
+
     def get_json_record_path(self, ix):
         return os.path.join(self.path, 'record_'+str(ix)+'.json')
 
     def get_json_record(self, ix):
+        if self.packed:
+            return self.get_packed_json_record(ix)
+
         path = self.get_json_record_path(ix)
         try:
             with open(path, 'r') as fp:
@@ -349,6 +803,18 @@ class Tub(object):
         return record_dict
 
 
+    def get_packed_json_record(self, ix):
+        offsets = self.get_packed_index()
+        if ix not in offsets:
+            raise FileNotFoundError('no record {} in tub {}'.format(ix, self.path))
+        offset, length = offsets[ix]
+        with open(self.packed_log_path, 'rb') as fp:
+            fp.seek(offset)
+            line = fp.read(length)
+        json_data = json.loads(line.split(b'\t', 1)[1].decode())
+        return self.make_record_paths_absolute(json_data)
+
+
     def get_record(self, ix):
 
         json_data = self.get_json_record(ix)
@@ -364,7 +830,11 @@ class Tub(object):
 
             #load objects that were saved as separate files
             if typ == 'image_array':
-                img = Image.open((val))
+                if isinstance(val, tuple):
+                    #packed tub: blob path, offset and length
+                    img = Image.open(io.BytesIO(read_blob(*val)))
+                else:
+                    img = Image.open((val))
                 val = np.array(img)
 
             data[key] = val
@@ -384,48 +854,156 @@ class Tub(object):
         shutil.rmtree(self.path)
 
     def shutdown(self):
-        pass
+        if self.manifest_fp is not None:
+            self.manifest_fp.close()
+            self.manifest_fp = None
+        if self.packed_fps is not None:
+            for fp in self.packed_fps:
+                fp.close()
+            self.packed_fps = None
 
 
-    def get_record_gen(self, record_transform=None, shuffle=True, df=None):
-
+    def get_record_gen(self, record_transform=None, shuffle=True, df=None, read_images=True,
+                       chunk_size=128):
+        '''
+        Yields the records of df (the tub df by default) as dicts, epoch
+        after epoch. Every epoch walks one permutation of the rows (their
+        order when shuffle is False) in chunks, each chunk taking its values
+        from the columns with one index per column.
+        '''
         if df is None:
             df = self.get_df()
 
+        keys = list(df.columns)
+        columns = [df[k].values for k in keys]
+        num_records = len(df)
+        if not num_records:
+            raise ValueError('no records to generate from')
 
         while True:
-            for row in self.df.iterrows():
-                if shuffle:
-                    record_dict = df.sample(n=1).to_dict(orient='record')[0]
+            if shuffle:
+                order = np.random.permutation(num_records)
+            else:
+                order = np.arange(num_records)
+
+            for start in range(0, num_records, chunk_size):
+                rows = order[start:start + chunk_size]
+                yield from self.records_at(keys, columns, rows, record_transform, read_images)
+
+    def records_at(self, keys, columns, rows, record_transform=None, read_images=True):
+        '''
+        the records at the given rows of the columns, one index per column
+        '''
+        chunk = [column[rows].tolist() for column in columns]
+        for values in zip(*chunk):
+            record_dict = dict(zip(keys, values))
 
-                if record_transform:
-                    record_dict = record_transform(record_dict)
+            if record_transform:
+                record_dict = record_transform(record_dict)
 
+            if read_images:
                 record_dict = self.read_record(record_dict)
 
-                yield record_dict
+            yield record_dict
 
 
-    def get_batch_gen(self, keys, record_transform=None, batch_size=128, shuffle=True, df=None):
+    def cache_tubs(self):
+        return [self]
 
-        record_gen = self.get_record_gen(record_transform, shuffle=shuffle, df=df)
+    def get_cache_rows(self):
+        '''
+        For every image key, maps the image values of the records (as in the
+        df) to their cache and row, for the tubs with an up to date cache.
+        '''
+        rows = {}
+        for tub in self.cache_tubs():
+            cache = TubCache(tub)
+            if cache.load():
+                for key, key_rows in cache.rows().items():
+                    rows.setdefault(key, {}).update(key_rows)
+        return rows
+
+    def read_cached_images(self, key, values, rows, out=None):
+        '''
+        The images of a batch gathered from the caches, with one fancy index
+        per cache, into out when it is given. Images missing from the caches
+        are decoded.
+        '''
+        locations = [rows.get(val) for val in values]
+        caches = {loc[0] for loc in locations if loc is not None}
+        if len(caches) == 1 and None not in locations:
+            cache = caches.pop()
+            images = np.asarray(cache.arrays[key])
+            return np.take(images, [row for _, row in locations], axis=0, out=out)
+
+        images = [None] * len(values) if out is None else out
+        for cache in caches:
+            positions = [i for i, loc in enumerate(locations) if loc is not None and loc[0] is cache]
+            gathered = np.asarray(cache.arrays[key])[[locations[i][1] for i in positions]]
+            for i, img in zip(positions, gathered):
+                images[i] = img
+        for i, loc in enumerate(locations):
+            if loc is None:
+                images[i] = self.read_record({key: values[i]})[key]
+        return np.array(images) if out is None else out
+
+    def get_batch_gen(self, keys, record_transform=None, batch_size=128, shuffle=True, df=None,
+                      use_cache=True, num_buffers=None):
+        '''
+        Yields dicts with an array of batch_size values for each key.
+
+        Array values, like images, are copied into the buffer of their key
+        as the records are read. With num_buffers None every batch gets new
+        buffers. With num_buffers N the batches cycle through N sets of
+        buffers, so a batch is overwritten N batches later: use 1 when each
+        batch is done with before asking for the next one, 2 to hold a batch
+        while the next is filled.
+        '''
+        #images come from the tub caches when they are built, see TubCache
+        cache_rows = self.get_cache_rows() if use_cache else {}
+        record_gen = self.get_record_gen(record_transform, shuffle=shuffle, df=df,
+                                         read_images=not cache_rows)
 
         if keys == None:
             keys = list(self.df.columns)
 
+        buffer_sets = [{} for _ in range(num_buffers or 0)]
+        batch_num = 0
         while True:
-            record_list = []
-            for _ in range(batch_size):
-                record_list.append(next(record_gen))
-
-            batch_arrays = {}
-            for i, k in enumerate(keys):
-                arr = np.array([r[k] for r in record_list])
-                # if len(arr.shape) == 1:
-                #    arr = arr.reshape(arr.shape + (1,))
-                batch_arrays[k] = arr
+            buffers = buffer_sets[batch_num % num_buffers] if num_buffers else {}
+            batch_num += 1
+            records = (next(record_gen) for _ in range(batch_size))
+            yield self.fill_batch(keys, records, batch_size, cache_rows, buffers)
 
-            yield batch_arrays
+    def fill_batch(self, keys, records, batch_size, cache_rows, buffers):
+        '''
+        The arrays of a batch of records. Array values are copied into the
+        buffers, which are allocated when missing.
+        '''
+        cached_keys = [k for k in keys if cache_rows and self.get_input_type(k) == 'image_array']
+        value_lists = {k: [] for k in keys}
+        for i, record in enumerate(records):
+            for k in keys:
+                val = record[k]
+                if isinstance(val, np.ndarray) and k not in cached_keys:
+                    buf = buffers.get(k)
+                    if buf is None:
+                        buf = buffers[k] = np.empty((batch_size,) + val.shape, dtype=val.dtype)
+                    np.copyto(buf[i], val, casting='same_kind')
+                else:
+                    value_lists[k].append(val)
+
+        batch_arrays = {}
+        for k in keys:
+            if k in cached_keys:
+                arr = buffers[k] = self.read_cached_images(
+                    k, value_lists[k], cache_rows.get(k, {}), out=buffers.get(k))
+            elif value_lists[k]:
+                arr = np.array(value_lists[k])
+            else:
+                arr = buffers[k]
+            batch_arrays[k] = arr
+        return batch_arrays
 
 
     def get_train_gen(self, X_keys, Y_keys, batch_size=128, record_transform=None, df=None):
@@ -440,10 +1018,24 @@ class Tub(object):
             yield X, Y
 
 
-    def get_train_val_gen(self, X_keys, Y_keys, batch_size=128, record_transform=None, train_frac=.8):
+    def get_train_val_gen(self, X_keys, Y_keys, batch_size=128, record_transform=None, train_frac=.8,
+                          workers=0, prefetch=None, use_processes=False, seed=None):
+        '''
+        Generators of the training and validation batches. With workers, the
+        batches are assembled by a pool of that many threads (processes with
+        use_processes) keeping prefetch batches ahead, see TubLoader. The
+        pool shuts down when either generator is closed or collected.
+        '''
         train_df = train=self.df.sample(frac=train_frac,random_state=200)
         val_df = self.df.drop(train_df.index)
 
+        if workers:
+            loader = TubLoader(self, {'train': train_df, 'val': val_df}, batch_size=batch_size,
+                               record_transform=record_transform, workers=workers,
+                               prefetch=prefetch, use_processes=use_processes, seed=seed)
+            return closing_gen(loader.get_train_gen('train', X_keys, Y_keys), loader), \
+                   closing_gen(loader.get_train_gen('val', X_keys, Y_keys), loader)
+
         train_gen = self.get_train_gen(X_keys=X_keys, Y_keys=Y_keys, batch_size=batch_size,
                                        record_transform=record_transform, df=train_df)
 
@@ -453,12 +1045,177 @@ class Tub(object):
         return train_gen, val_gen
 
 
+#the loader of a worker process, see init_loader_worker
+worker_loader = None
+
 
+def init_loader_worker(tub, dfs, batch_size, record_transform, use_cache):
+    global worker_loader
+    worker_loader = TubLoader(tub, dfs, batch_size, record_transform, workers=0,
+                              use_cache=use_cache)
+
+
+def load_worker_batch(*args):
+    return worker_loader.load_batch(*args)
+
+
+def closing_gen(gen, loader):
+    '''
+    yields from gen and shuts the loader down when closed
+    '''
+    try:
+        yield from gen
+    finally:
+        loader.shutdown()
+
+
+class TubLoader:
+    '''
+    Assembles the batches of a tub (or TubGroup) in a pool of worker
+    threads, or processes with use_processes, while the model trains on the
+    previous ones. `prefetch` batches (twice the workers by default) are
+    queued ahead.
+
+    The rows of every batch are drawn in the generator from one permutation
+    per epoch and the batches come back in that order, so with a seed the
+    batches don't depend on the number of workers. Worker processes also
+    seed `random` and `np.random` for each batch, for record transforms
+    that augment at random.
+
+    dfs maps names to the dfs to load from, for example the training and
+    validation records, which share the workers. Processes start with a
+    copy of the tub and dfs; the record transform must be a module level
+    function when processes are not forked.
+    '''
+
+    def __init__(self, tub, dfs, batch_size=128, record_transform=None, workers=4,
+                 prefetch=None, use_processes=False, seed=None, use_cache=True):
+        self.tub = tub
+        self.batch_size = batch_size
+        self.record_transform = record_transform
+        self.prefetch = prefetch or max(1, 2 * workers)
+        self.seed = seed
+        self.seed_batches = use_processes
+        #sorted, the seed of each df must not depend on the dict order
+        self.names = sorted(dfs)
+        self.columns = {name: (list(df.columns), [df[k].values for k in df.columns])
+                        for name, df in dfs.items()}
+        self.num_records = {name: len(df) for name, df in dfs.items()}
+        self.cache_rows = {}
+        self.pool = None
+        self.closed = False
+        self.load = self.load_batch
+
+        if use_processes and workers:
+            #each worker process loads with its own TubLoader without workers
+            self.pool = multiprocessing.Pool(
+                workers, initializer=init_loader_worker,
+                initargs=(tub, dfs, batch_size, record_transform, use_cache))
+            self.load = load_worker_batch
+        else:
+            self.cache_rows = tub.get_cache_rows() if use_cache else {}
+            if workers:
+                self.pool = multiprocessing.pool.ThreadPool(workers)
+
+    def load_batch(self, name, rows, keys, seed=None):
+        '''
+        the arrays of the keys for the records at rows of the named df
+        '''
+        if seed is not None:
+            random.seed(seed)
+            np.random.seed(seed)
+        df_keys, columns = self.columns[name]
+        records = self.tub.records_at(df_keys, columns, rows, self.record_transform,
+                                      read_images=not self.cache_rows)
+        return self.tub.fill_batch(keys, records, len(rows), self.cache_rows, {})
+
+    def submit(self, *args):
+        if self.closed:
+            raise RuntimeError('the tub loader is shut down')
+        future = concurrent.futures.Future()
+        if self.pool is None:
+            future.set_result(self.load(*args))
+        else:
+            self.pool.apply_async(self.load, args, callback=future.set_result,
+                                  error_callback=future.set_exception)
+        return future
+
+    def batch_rows(self, name, rng, shuffle=True):
+        '''
+        the rows of the batches, epoch after epoch. The rows left over at
+        the end of an epoch start the first batch of the next one.
+        '''
+        num_records = self.num_records[name]
+        if not num_records:
+            raise ValueError('no records to load in {}'.format(name))
+        leftover = np.empty(0, dtype=np.int64)
+        while True:
+            order = rng.permutation(num_records) if shuffle else np.arange(num_records)
+            order = np.concatenate([leftover, order])
+            end = len(order) - len(order) % self.batch_size
+            for start in range(0, end, self.batch_size):
+                yield order[start:start + self.batch_size]
+            leftover = order[end:]
+
+    def get_batch_gen(self, name, keys, shuffle=True):
+        '''
+        yields dicts with an array of batch_size values for each key
+        '''
+        seed = self.seed
+        if seed is not None:
+            seed = [seed, self.names.index(name)]
+        rng = np.random.RandomState(seed)
+        batch_rows = self.batch_rows(name, rng, shuffle)
+        pending = collections.deque()
+        while True:
+            while len(pending) < self.prefetch:
+                #drawn in any case so the rows don't depend on seed_batches
+                batch_seed = rng.randint(2**31)
+                if self.seed is None or not self.seed_batches:
+                    batch_seed = None
+                pending.append(self.submit(name, next(batch_rows), keys, batch_seed))
+            yield pending.popleft().result()
+
+    def get_train_gen(self, name, X_keys, Y_keys, shuffle=True):
+        for batch in self.get_batch_gen(name, X_keys + Y_keys, shuffle):
+            X = [batch[k] for k in X_keys]
+            Y = [batch[k] for k in Y_keys]
+            yield X, Y
+
+    def shutdown(self):
+        '''
+        stops the workers, dropping the batches they are assembling
+        '''
+        self.closed = True
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool = None
 
 
 class TubWriter(Tub):
-    def __init__(self, *args, **kwargs):
+    '''
+    Tub part saving the values of its inputs on every run.
+
+    With a queue_size, run only puts the record in a queue of that size and
+    a thread encodes and writes the queued records in batches, so the drive
+    loop doesn't wait for the disk. When the queue is full, drop_policy
+    'oldest' drops the oldest queued record, 'newest' drops the new record
+    and 'block' waits for room in the queue.
+    '''
+    DROP_POLICIES = ('oldest', 'newest', 'block')
+
+    def __init__(self, *args, queue_size=0, drop_policy='oldest', batch_size=32, **kwargs):
         super(TubWriter, self).__init__(*args, **kwargs)
+        if drop_policy not in self.DROP_POLICIES:
+            raise ValueError('drop_policy must be one of {}'.format(self.DROP_POLICIES))
+        self.drop_policy = drop_policy
+        self.batch_size = batch_size
+        self.queue = None
+        self.writer = None
+        if queue_size:
+            self.queue = queue.Queue(maxsize=queue_size)
+            self.writer = threading.Thread(target=self.write_queued, daemon=True)
+            self.writer.start()
 
     def run(self, *args):
         '''
@@ -471,7 +1228,69 @@ class TubWriter(Tub):
 
         self.record_time = int(time.time() - self.start_time)
         record = dict(zip(self.inputs, args))
-        self.put_record(record)
+        if self.queue is None:
+            self.put_record(record)
+        else:
+            self.enqueue(record)
+
+    def enqueue(self, record):
+        for key, val in record.items():
+            #views, like the arrays of a part in its own process, may be
+            #overwritten before the record is written
+            if isinstance(val, np.ndarray) and not val.flags.owndata:
+                record[key] = val.copy()
+
+        if self.drop_policy == 'block':
+            self.queue.put(record)
+        else:
+            try:
+                self.queue.put_nowait(record)
+            except queue.Full:
+                TUB_DROPPED.inc()
+                if self.drop_policy == 'oldest':
+                    try:
+                        self.queue.get_nowait()
+                    except queue.Empty:
+                        pass
+                    self.queue.put_nowait(record)
+        TUB_QUEUE_DEPTH.set(self.queue.qsize())
+
+    def write_queued(self):
+        '''
+        loop of the writer thread, until it gets None from the queue
+        '''
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            stop = False
+            self.deferred_flush = True
+            for record in batch:
+                if record is None:
+                    stop = True
+                    continue
+                try:
+                    self.put_record(record)
+                except Exception as e:
+                    print('Tub writer could not save a record:', e)
+            self.deferred_flush = False
+            self.flush()
+            TUB_QUEUE_DEPTH.set(self.queue.qsize())
+
+            if stop:
+                break
+
+    def shutdown(self):
+        if self.writer is not None:
+            #the records queued so far are written first
+            self.queue.put(None)
+            self.writer.join()
+            self.writer = None
+        super(TubWriter, self).shutdown()
 
 
 class TubReader(Tub):
@@ -519,12 +1338,186 @@ class TubHandler():
         tub_path = os.path.join(self.path, name)
         return tub_path
 
-    def new_tub_writer(self, inputs, types):
+    def new_tub_writer(self, inputs, types, format='files', **kwargs):
         tub_path = self.create_tub_path()
-        tw = TubWriter(path=tub_path, inputs=inputs, types=types)
+        tw = TubWriter(path=tub_path, inputs=inputs, types=types, format=format, **kwargs)
         return tw
 
 
+def convert_tub(src_path, dst_path, format='packed'):
+    '''
+    Copy the tub at src_path to a new tub at dst_path saved in the given
+    format ('files' or 'packed'). Records keep their index and images are
+    copied without encoding them again.
+    '''
+    src = Tub(src_path)
+    dst = Tub(dst_path, inputs=src.inputs, types=src.types, format=format)
+    for ix in src.get_index(shuffled=False):
+        record = {}
+        for key, val in src.get_json_record(ix).items():
+            if src.get_input_type(key) == 'image_array':
+                if isinstance(val, tuple):
+                    val = read_blob(*val)
+                else:
+                    with open(val, 'rb') as fp:
+                        val = fp.read()
+            record[key] = val
+        dst.put_encoded_record(ix, record)
+    dst.current_ix = src.current_ix
+    dst.shutdown()
+    return dst
+
+
+class TubCache:
+    '''
+    The decoded images of a tub in memory mapped numpy files, in the cache
+    directory of the tub: one uint8 array of shape (records, height, width,
+    channels) per image_array key. Build it once with `build` (or
+    `donkey tubcache`), the batch generators of the tub then gather the
+    images of a batch from it instead of opening and decoding every jpeg.
+
+    The cache saves the signature of the tub it was built from; after
+    records are added or removed it doesn't load until it is built again.
+    '''
+
+    def __init__(self, tub):
+        self.tub = tub
+        self.path = os.path.join(tub.path, CACHE_DIR)
+        self.meta_path = os.path.join(self.path, 'meta.json')
+        self.meta = None
+        self.arrays = {}
+
+    def array_path(self, key):
+        return os.path.join(self.path, key.replace('/', '-') + '.npy')
+
+    def relative_value(self, val):
+        #image values as saved in the records, so a moved tub keeps its cache
+        if isinstance(val, tuple):
+            return [val[1], val[2]]
+        return os.path.relpath(val, self.tub.path)
+
+    def build(self):
+        '''
+        decode all the records of the tub into the cache, returns the
+        number of records
+        '''
+        tub = self.tub
+        #created first, it changes the time of a tub directory without manifest
+        os.makedirs(self.path, exist_ok=True)
+        index = tub.get_index(shuffled=False)
+        #taken before reading, records added meanwhile make the cache out of date
+        signature = tub.signature()
+        if os.path.exists(self.meta_path):
+            os.remove(self.meta_path)
+
+        records = []
+        for ix in index:
+            try:
+                records.append((ix, tub.get_json_record(ix)))
+            except FileNotFoundError:
+                pass
+
+        image_keys = [k for k, t in zip(tub.inputs, tub.types) if t == 'image_array']
+        images = {}
+        values = {k: [] for k in image_keys}
+        for row, (ix, json_data) in enumerate(records):
+            for key in image_keys:
+                img = tub.read_record({key: json_data[key]})[key]
+                if key not in images:
+                    images[key] = np.lib.format.open_memmap(
+                        self.array_path(key), mode='w+', dtype=np.uint8,
+                        shape=(len(records),) + img.shape)
+                if img.shape != images[key].shape[1:]:
+                    raise ValueError('record {} {} has shape {}, expected {}'.format(
+                        ix, key, img.shape, images[key].shape[1:]))
+                images[key][row] = img
+                values[key].append(self.relative_value(json_data[key]))
+        for arr in images.values():
+            arr.flush()
+
+        #written last, an interrupted build leaves no cache
+        meta = {'signature': signature,
+                'index': [ix for ix, _ in records],
+                'images': list(images.keys()),
+                'values': values}
+        tmp_path = self.meta_path + '.tmp'
+        with open(tmp_path, 'w') as fp:
+            json.dump(meta, fp)
+        os.replace(tmp_path, self.meta_path)
+        return len(records)
+
+    def load(self):
+        '''
+        open the arrays, returns False when there is no cache or the tub
+        changed since it was built
+        '''
+        try:
+            with open(self.meta_path, 'r') as fp:
+                meta = json.load(fp)
+            if meta['signature'] != self.tub.signature():
+                print('Tub changed since its cache was built, not using it: {}'.format(self.tub.path))
+                return False
+            self.arrays = {key: np.load(self.array_path(key), mmap_mode='r')
+                           for key in meta['images']}
+        except (FileNotFoundError, ValueError, KeyError):
+            return False
+        self.meta = meta
+        return True
+
+    def rows(self):
+        '''
+        for every image key, the image values of the records (as returned by
+        get_json_record) mapped to this cache and their row
+        '''
+        tub = self.tub
+        rows = {}
+        for key, values in self.meta['values'].items():
+            key_rows = rows[key] = {}
+            for row, val in enumerate(values):
+                if isinstance(val, list):
+                    val = (tub.packed_blob_path, val[0], val[1])
+                else:
+                    val = os.path.join(tub.path, val)
+                key_rows[val] = (self, row)
+        return rows
+
+
+
+class LRUCache:
+    '''
+    Keeps the values of the last used keys, at most maxsize, and counts
+    the hits and misses.
+    '''
+
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.values = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, load):
+        '''
+        the value of key, load(key) when it isn't cached
+        '''
+        with self.lock:
+            if key in self.values:
+                self.values.move_to_end(key)
+                self.hits += 1
+                return self.values[key]
+            self.misses += 1
+
+        value = load(key)
+        with self.lock:
+            self.values[key] = value
+            self.values.move_to_end(key)
+            while len(self.values) > self.maxsize:
+                self.values.popitem(last=False)
+        return value
+
+    def stats(self):
+        return {'size': len(self.values), 'hits': self.hits, 'misses': self.misses}
+
 
 class TubImageStacker(Tub):
     '''
@@ -533,8 +1526,29 @@ class TubImageStacker(Tub):
     NN some chance of building a model based on motion.
     If you drive with the ImageFIFO part, then you don't need this.
     Just make sure your inference pass uses the ImageFIFO that the NN will now expect.
+
+    The last decoded records (frame_cache_size) and parsed json records
+    (json_cache_size) are kept in LRU caches, so a pass over the records
+    decodes each frame about once. The images of cached records are shared,
+    don't change them in place.
     '''
-    
+
+    def __init__(self, *args, frame_cache_size=64, json_cache_size=1024, **kwargs):
+        super(TubImageStacker, self).__init__(*args, **kwargs)
+        self.frame_cache = LRUCache(frame_cache_size)
+        self.json_cache = LRUCache(json_cache_size)
+
+    def get_cached_json_record(self, ix):
+        return self.json_cache.get(ix, self.get_json_record)
+
+    def get_cached_record(self, ix):
+        record = self.frame_cache.get(
+            ix, lambda ix: self.read_record(self.get_cached_json_record(ix)))
+        return dict(record)
+
+    def cache_stats(self):
+        return {'frames': self.frame_cache.stats(), 'json': self.json_cache.stats()}
+
     def rgb2gray(self, rgb):
         '''
         take a numpy rgb image return a new single channel image converted to greyscale
@@ -565,13 +1579,13 @@ class TubImageStacker(Tub):
         get the current record and two previous.
         stack the 3 images into a single image.
         '''
-        data = super(TubImageStacker, self).get_record(ix)
+        data = self.get_cached_record(ix)
 
         if ix > 1:
-            data_ch1 = super(TubImageStacker, self).get_record(ix - 1)
-            data_ch0 = super(TubImageStacker, self).get_record(ix - 2)
+            data_ch1 = self.get_cached_record(ix - 1)
+            data_ch0 = self.get_cached_record(ix - 2)
 
-            json_data = self.get_json_record(ix)
+            json_data = self.get_cached_json_record(ix)
             for key, val in json_data.items():
                 typ = self.get_input_type(key)
 
@@ -582,6 +1596,7 @@ class TubImageStacker(Tub):
                 elif typ == 'image_array':
                     img = self.stack3Images(data_ch0[key], data_ch1[key], data[key])
                     val = np.array(img)
+                    data[key] = val
 
         return data
 
@@ -615,7 +1630,7 @@ class TubTimeStacker(TubImageStacker):
             iRec = ix + iOffset
             
             try:
-                json_data = self.get_json_record(iRec)
+                json_data = self.get_cached_json_record(iRec)
             except FileNotFoundError:
                 pass
             except:
@@ -629,8 +1644,7 @@ class TubTimeStacker(TubImageStacker):
                     val = Image.open(os.path.join(self.path, val))
                     data[key] = val                    
                 elif typ == 'image_array' and i == 0:
-                    d = super(TubTimeStacker, self).get_record(ix)
-                    data[key] = d[key]
+                    data[key] = self.get_cached_record(ix)[key]
                 else:
                     '''
                     we append a _offset to the key
@@ -641,25 +1655,49 @@ class TubTimeStacker(TubImageStacker):
         return data
 
 
+def load_tub_df(path):
+    tub = Tub(path)
+    tub.update_df()
+    return tub.df
+
+
 class TubGroup(Tub):
-    def __init__(self, tub_paths_arg):
+    '''
+    The records of several tubs in one df, each loaded from the records
+    cache of the tub when it is up to date, see `Tub.update_df`. The tubs
+    load one after the other, or in a pool of `workers` processes. The pool
+    spawns fresh interpreters rather than forking, so it is safe to use
+    after tensorflow has started its threads.
+    '''
+    def __init__(self, tub_paths_arg, workers=None):
         tub_paths = utils.expand_path_arg(tub_paths_arg)
         print('TubGroup:tubpaths:', tub_paths)
         tubs = [Tub(path) for path in tub_paths]
         self.input_types = {}
 
+        workers = min(workers or 1, len(tubs))
+        if workers > 1:
+            with multiprocessing.get_context('spawn').Pool(workers) as pool:
+                for t, df in zip(tubs, pool.map(load_tub_df, [t.path for t in tubs])):
+                    t.df = df
+        else:
+            for t in tubs:
+                t.update_df()
+
         record_count = 0
         for t in tubs:
-            t.update_df()
             record_count += len(t.df)
             self.input_types.update(dict(zip(t.inputs, t.types)))
 
-        print('joining the tubs {} records together. This could take {} minutes.'.format(record_count,
-                                                                                         int(record_count / 300000)))
+        print('joining the tubs {} records together.'.format(record_count))
 
         self.meta = {'inputs': list(self.input_types.keys()),
                      'types': list(self.input_types.values())}
 
         self.df = pd.concat([t.df for t in tubs], axis=0, join='inner')
+        self.tubs = tubs
+
+    def cache_tubs(self):
+        return self.tubs
 
 
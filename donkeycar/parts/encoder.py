@@ -6,6 +6,7 @@ from datetime import datetime
 from donkeycar.parts.teensy import TeensyRCin
 import re
 import time
+import asyncio
 
 class AStarSpeed:
     def __init__(self):
@@ -17,44 +18,56 @@ class AStarSpeed:
         self.on = True
 
     def update(self):
-        encoder_pattern = re.compile('^E ([-0-9]+)( ([-0-9]+))?( ([-0-9]+))?$')
-        linaccel_pattern = re.compile('^L ([-.0-9]+) ([-.0-9]+) ([-.0-9]+) ([-0-9]+)$')
+        while self.on:
+            start = datetime.now()
+            self.poll()
+            stop = datetime.now()
+            s = 0.1 - (stop - start).total_seconds()
+            if s > 0:
+                time.sleep(s)
 
+    async def update_async(self):
         while self.on:
             start = datetime.now()
+            self.poll()
+            stop = datetime.now()
+            s = 0.1 - (stop - start).total_seconds()
+            await asyncio.sleep(max(s, 0))
 
-            l = self.sensor.astar_readline()
-            while l:
-                m = encoder_pattern.match(l.decode('utf-8'))
+    def poll(self):
+        '''
+        read all the lines the AStar board sent since the last poll
+        '''
+        encoder_pattern = re.compile('^E ([-0-9]+)( ([-0-9]+))?( ([-0-9]+))?$')
+        linaccel_pattern = re.compile('^L ([-.0-9]+) ([-.0-9]+) ([-.0-9]+) ([-0-9]+)$')
 
-                if m:
-                    value = int(m.group(1))
-                    # rospy.loginfo("%s: Receiver E got %d" % (self.node_name, value))
-                    # Speed
-                    # 40 ticks/wheel rotation,
-                    # circumfence 0.377m
-                    # every 0.1 seconds
-                    if len(m.group(3)) > 0:
-                        period = 0.001 * int(m.group(3))
-                    else:
-                        period = 0.1
-
-                    self.speed = 0.377 * (float(value) / 40) / period   # now in m/s
+        l = self.sensor.astar_readline()
+        while l:
+            m = encoder_pattern.match(l.decode('utf-8'))
+
+            if m:
+                value = int(m.group(1))
+                # rospy.loginfo("%s: Receiver E got %d" % (self.node_name, value))
+                # Speed
+                # 40 ticks/wheel rotation,
+                # circumfence 0.377m
+                # every 0.1 seconds
+                if len(m.group(3)) > 0:
+                    period = 0.001 * int(m.group(3))
                 else:
-                    m = linaccel_pattern.match(l.decode('utf-8'))
+                    period = 0.1
 
-                    if m:
-                        la = { 'x': float(m.group(1)), 'y': float(m.group(2)), 'z': float(m.group(3)) }
+                self.speed = 0.377 * (float(value) / 40) / period   # now in m/s
+            else:
+                m = linaccel_pattern.match(l.decode('utf-8'))
 
-                        self.linaccel = la
-                        print("mw linaccel= " + str(self.linaccel))
+                if m:
+                    la = { 'x': float(m.group(1)), 'y': float(m.group(2)), 'z': float(m.group(3)) }
 
-                l = self.sensor.astar_readline()
+                    self.linaccel = la
+                    print("mw linaccel= " + str(self.linaccel))
 
-            stop = datetime.now()
-            s = 0.1 - (stop - start).total_seconds()
-            if s > 0:
-                time.sleep(s)
+            l = self.sensor.astar_readline()
 
     def run_threaded(self):
         return self.speed # , self.linaccel
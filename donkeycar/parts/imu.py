@@ -1,4 +1,5 @@
 import time
+import asyncio
 
 class Mpu6050:
     '''
@@ -27,6 +28,11 @@ class Mpu6050:
         while self.on:
             self.poll()
             time.sleep(self.poll_delay)
+
+    async def update_async(self):
+        while self.on:
+            self.poll()
+            await asyncio.sleep(self.poll_delay)
                 
     def poll(self):
         self.accel, self.gyro, self.temp = self.sensor.get_all_data()
@@ -22,9 +22,13 @@ import tensorflow as tf
 import donkeycar as dk
 import donkeycar.constant as Constant
 from donkeycar.parts.fuzzy import fuzzy
+from donkeycar import metrics
 
 POLL_DELAY_KERAS = 0.05    # seconds
 
+PREDICTIONS = metrics.counter('donkey_pilot_predictions_total', 'Predictions made by the pilot')
+INFERENCE_SECONDS = metrics.histogram('donkey_pilot_inference_seconds', 'Time of a model prediction')
+
 class KerasPilot():
  
     def load(self, model_path):
@@ -38,6 +42,17 @@ class KerasPilot():
     def shutdown(self):
         pass
     
+
+    def predict_timed(self, inputs):
+        '''
+        model.predict counting the predictions and their time
+        '''
+        start = time.perf_counter()
+        outputs = self.model.predict(inputs)
+        INFERENCE_SECONDS.observe(time.perf_counter() - start)
+        PREDICTIONS.inc()
+        return outputs
+
     
     def train(self, train_gen, val_gen, 
               saved_model_path, epochs=100, steps=100, train_split=0.8,
@@ -88,7 +103,7 @@ class KerasCategorical(KerasPilot):
         
     def run(self, img_arr):
         img_arr = img_arr.reshape((1,) + img_arr.shape)
-        angle_binned, throttle = self.model.predict(img_arr)
+        angle_binned, throttle = self.predict_timed(img_arr)
         #print('throttle', throttle)
         #angle_certainty = max(angle_binned[0])
         angle_unbinned = dk.utils.linear_unbin(angle_binned)
@@ -107,7 +122,7 @@ class KerasLinear(KerasPilot):
             self.model = default_linear()
     def run(self, img_arr):
         img_arr = img_arr.reshape((1,) + img_arr.shape)
-        outputs = self.model.predict(img_arr)
+        outputs = self.predict_timed(img_arr)
         #print(len(outputs), outputs)
         steering = outputs[0]
         throttle = outputs[1]
@@ -148,7 +163,7 @@ class KerasIMU(KerasPilot):
         #TODO: would be nice to take a vector input array.
         img_arr = img_arr.reshape((1,) + img_arr.shape)
         imu_arr = np.array([accel_x, accel_y, accel_z, gyr_x, gyr_y, gyr_z, temp]).reshape(1,self.num_imu_inputs)
-        outputs = self.model.predict([img_arr, imu_arr])
+        outputs = self.predict_timed([img_arr, imu_arr])
         steering = outputs[0]
         throttle = outputs[1]
         return steering[0][0], throttle[0][0]
@@ -184,7 +199,7 @@ class KerasFuzzyAndUltrasonicSensors(KerasPilot):
         img_arr = self.img_arr.reshape((1,) + self.img_arr.shape)
         a1 = time.time()
         with self.graph.as_default():
-            steering, throttle = self.model.predict([img_arr])
+            steering, throttle = self.predict_timed([img_arr])
         #print('throttle', throttle)
         #angle_certainty = max(angle_binned[0])
         angle_unbinned = dk.utils.linear_unbin(steering)
@@ -268,7 +283,7 @@ class KerasUltrasonicSensors(KerasPilot):
         img_arr = self.img_arr.reshape((1,) + self.img_arr.shape)
 
         with self.graph.as_default():
-            steering, throttle = self.model.predict([img_arr])
+            steering, throttle = self.predict_timed([img_arr])
 
         angle_unbinned = dk.utils.linear_unbin(steering)
         angle_nn = angle_unbinned
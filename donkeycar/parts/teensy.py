@@ -2,6 +2,7 @@ from datetime import datetime
 import donkeycar as dk
 import re
 import time
+import asyncio
 
 class TeensyRCin:
     def __init__(self):
@@ -34,46 +35,58 @@ class TeensyRCin:
         return ((x-X_min) / XY_ratio + Y_min)
 
     def update(self):
-        rcin_pattern = re.compile('^I +([.0-9]+) +([.0-9]+).*$')
-
         while self.on:
             start = datetime.now()
-
-            l = self.sensor.teensy_readline()
-
-            while l:
-                # print("mw TeensyRCin line= " + l.decode('utf-8'))
-                m = rcin_pattern.match(l.decode('utf-8'))
-
-                if m:
-                    i = float(m.group(1))
-                    if i == 0.0:
-                        self.inSteering = 0.0
-                    else:
-                        i = i / (1000.0 * 1000.0) # in seconds
-                        i *= self.sensor.frequency * 4096.0
-                        self.inSteering = self.map_range(i,
-                                                         TeensyRCin.LEFT_PULSE, TeensyRCin.RIGHT_PULSE,
-                                                         TeensyRCin.LEFT_ANGLE, TeensyRCin.RIGHT_ANGLE)
-
-                    k = float(m.group(2))
-                    if k == 0.0:
-                        self.inThrottle = 0.0
-                    else:
-                        k = k / (1000.0 * 1000.0) # in seconds
-                        k *= self.sensor.frequency * 4096.0
-                        self.inThrottle = self.map_range(k,
-                                                         TeensyRCin.MIN_PULSE, TeensyRCin.MAX_PULSE,
-                                                         TeensyRCin.MIN_THROTTLE, TeensyRCin.MAX_THROTTLE)
-
-                    # print("matched %.1f  %.1f  %.1f  %.1f" % (i, self.inSteering, k, self.inThrottle))
-                l = self.sensor.teensy_readline()
-
+            self.poll()
             stop = datetime.now()
             s = 0.01 - (stop - start).total_seconds()
             if s > 0:
                 time.sleep(s)
 
+    async def update_async(self):
+        while self.on:
+            start = datetime.now()
+            self.poll()
+            stop = datetime.now()
+            s = 0.01 - (stop - start).total_seconds()
+            await asyncio.sleep(max(s, 0))
+
+    def poll(self):
+        '''
+        read all the lines the Teensy sent since the last poll
+        '''
+        rcin_pattern = re.compile('^I +([.0-9]+) +([.0-9]+).*$')
+
+        l = self.sensor.teensy_readline()
+
+        while l:
+            # print("mw TeensyRCin line= " + l.decode('utf-8'))
+            m = rcin_pattern.match(l.decode('utf-8'))
+
+            if m:
+                i = float(m.group(1))
+                if i == 0.0:
+                    self.inSteering = 0.0
+                else:
+                    i = i / (1000.0 * 1000.0) # in seconds
+                    i *= self.sensor.frequency * 4096.0
+                    self.inSteering = self.map_range(i,
+                                                     TeensyRCin.LEFT_PULSE, TeensyRCin.RIGHT_PULSE,
+                                                     TeensyRCin.LEFT_ANGLE, TeensyRCin.RIGHT_ANGLE)
+
+                k = float(m.group(2))
+                if k == 0.0:
+                    self.inThrottle = 0.0
+                else:
+                    k = k / (1000.0 * 1000.0) # in seconds
+                    k *= self.sensor.frequency * 4096.0
+                    self.inThrottle = self.map_range(k,
+                                                     TeensyRCin.MIN_PULSE, TeensyRCin.MAX_PULSE,
+                                                     TeensyRCin.MIN_THROTTLE, TeensyRCin.MAX_THROTTLE)
+
+                # print("matched %.1f  %.1f  %.1f  %.1f" % (i, self.inSteering, k, self.inThrottle))
+            l = self.sensor.teensy_readline()
+
     def run_threaded(self):
         return self.inSteering, self.inThrottle
 
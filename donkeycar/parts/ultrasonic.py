@@ -3,10 +3,18 @@ Ultrasonic
 """
 
 import time
+import asyncio
 import numpy as np
-import RPi.GPIO as GPIO
+try:
+    import RPi.GPIO as GPIO
+except ImportError:
+    #only the Ultrasonic part reads the sensor, the mock and the cache
+    #client work without a Pi
+    GPIO = None
 import sys
 
+from donkeycar import metrics
+
 ULTRASONIC_DEFAULT_DISTANCE = 800.00
 ULTRASONIC_RETRY = 3
 ULTRASONIC_MEAN_LENGTH = 5
@@ -38,6 +46,9 @@ class Ultrasonic():
         GPIO.setup(self.gpio_trigger, GPIO.OUT)
         GPIO.setup(self.gpio_echo, GPIO.IN)
 
+        self.timeouts = metrics.counter('donkey_ultrasonic_timeouts_total',
+                                        'Ultrasonic readings without an echo', {'sensor': name})
+
         self.distance = 0.0
         self.distance_array = []
         #for i in range(1, ULTRASONIC_MEAN_LENGTH):
@@ -137,6 +148,7 @@ class Ultrasonic():
             n=n+1
             if n > 3000:
                 #print("d %i %i" % (GPIO.input(self.gpio_echo), n))
+                self.timeouts.inc()
                 return (ULTRASONIC_DEFAULT_DISTANCE+1)
         #print("d %i %i" % (GPIO.input(self.gpio_echo), n))
 
@@ -146,6 +158,7 @@ class Ultrasonic():
             n=n+1
             if n > 3000:
                 #print("e %i %i" % (GPIO.input(self.gpio_echo), n))
+                self.timeouts.inc()
                 return (ULTRASONIC_DEFAULT_DISTANCE+2)
         #print("e %i %i" % (GPIO.input(self.gpio_echo), n))
 
@@ -216,6 +229,11 @@ class MockUltrasonic():
         while self.on:
             self.distance = self.poll_distance()
             time.sleep(self.poll_delay)
+
+    async def update_async(self):
+        while self.on:
+            self.distance = self.poll_distance()
+            await asyncio.sleep(self.poll_delay)
             
     def run_threaded(self):
         return self.distance
@@ -276,6 +294,13 @@ class CacheUltrasonicClient():
         while self.on:
             self.distance = self.poll_distance()
             time.sleep(self.poll_delay)
+
+    async def update_async(self):
+        #the memcache client blocks, keep it off the event loop
+        loop = asyncio.get_event_loop()
+        while self.on:
+            self.distance = await loop.run_in_executor(None, self.poll_distance)
+            await asyncio.sleep(self.poll_delay)
             
     def run_threaded(self):
         return self.distance
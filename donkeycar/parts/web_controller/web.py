@@ -23,6 +23,7 @@ import tornado.web
 import tornado.gen
 
 from ... import utils
+from ... import metrics
 
 
 class RemoteWebServer():
@@ -39,6 +40,8 @@ class RemoteWebServer():
         self.throttle = 0.
         self.mode = 'user'
         self.recording = False
+        #responses received, see Vehicle.add max_age
+        self.update_count = 0
         #use one session for all requests
         self.session = requests.Session()
 
@@ -53,6 +56,7 @@ class RemoteWebServer():
         while True:
             #get latest value from server
             self.angle, self.throttle, self.mode, self.recording = self.run()
+            self.update_count += 1
 
 
     def run_threaded(self):
@@ -131,6 +135,7 @@ class LocalWebController(tornado.web.Application):
             (r"/drive", DriveAPI),
             (r"/ultrasonic", UltrasonicSensorAPI),
             (r"/video_front",VideoAPI),
+            (r"/metrics", MetricsAPI),
             (r"/static/(.*)", tornado.web.StaticFileHandler, {"path": self.static_file_path}),
             ]
 
@@ -194,6 +199,14 @@ class UltrasonicSensorAPI(tornado.web.RequestHandler):
         self.set_header('Content-Type', 'application/json')
         self.write(json.dumps(data))
 			
+class MetricsAPI(tornado.web.RequestHandler):
+    '''
+    Serves the metrics of the car in the Prometheus text format.
+    '''
+    def get(self):
+        self.set_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.write(metrics.render())
+
 class DriveAPI(tornado.web.RequestHandler):
     @tornado.web.asynchronous
     @tornado.gen.coroutine
@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+process.py
+
+Run a part in its own process so it doesn't share the GIL with the drive
+loop. Numpy arrays go through shared memory blocks, everything else is
+pickled through a pipe.
+
+The part process is started with 'spawn' by default: forking a process
+that already runs TensorFlow (or any library with threads) is not safe.
+Parts that can't be pickled, like a Keras pilot with its model loaded,
+are built in the part process from a factory instead, e.g. a
+functools.partial of a module level function loading the model.
+"""
+
+import signal
+import traceback
+import multiprocessing as mp
+from multiprocessing import shared_memory, resource_tracker
+
+import numpy as np
+
+
+class SharedArrays:
+    '''
+    Numpy arrays passed between two processes through shared memory.
+
+    The side sending an array owns the block it is copied into. A block is
+    kept between calls and only replaced when an array doesn't fit anymore.
+    Each argument position alternates between two blocks, so the array
+    received on one call is not overwritten before the following call.
+    The receiving side gets a numpy view onto the block, without a copy.
+
+    Numpy views don't keep a block mapped, so the receiving side never
+    unmaps the blocks it attached: they stay mapped until the process
+    exits, which keeps the arrays handed out valid.
+    '''
+
+    def __init__(self):
+        self.owned = {}
+        self.flips = {}
+        self.attached = {}
+        self.replaced = []
+
+    def pack(self, position, value):
+        if not isinstance(value, np.ndarray) or value.dtype.hasobject:
+            return ('value', value)
+
+        flip = self.flips.get(position, 0)
+        self.flips[position] = 1 - flip
+        key = (position, flip)
+
+        shm = self.owned.get(key)
+        if shm is None or shm.size < value.nbytes:
+            if shm is not None:
+                shm.close()
+                shm.unlink()
+            shm = shared_memory.SharedMemory(create=True, size=max(value.nbytes, 1))
+            self.owned[key] = shm
+
+        view = np.ndarray(value.shape, dtype=value.dtype, buffer=shm.buf)
+        view[...] = value
+        del view
+        return ('array', key, shm.name, value.shape, value.dtype.str)
+
+    def unpack(self, desc):
+        if desc[0] == 'value':
+            return desc[1]
+
+        _, key, name, shape, dtype = desc
+        shm = self.attached.get(key)
+        if shm is None or shm.name != name:
+            if shm is not None:
+                self.replaced.append(shm)
+            shm = self.attached[key] = shared_memory.SharedMemory(name=name)
+        return np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+    def close(self):
+        '''
+        remove the blocks this side created
+        '''
+        for shm in self.owned.values():
+            shm.close()
+            shm.unlink()
+        self.owned = {}
+
+
+def pack_outputs(arrays, outputs):
+    if outputs is None:
+        return ('none',)
+    if isinstance(outputs, (tuple, list)):
+        return ('many', [arrays.pack(i, v) for i, v in enumerate(outputs)])
+    return ('one', arrays.pack(0, outputs))
+
+
+def unpack_outputs(arrays, packed):
+    if packed[0] == 'none':
+        return None
+    if packed[0] == 'many':
+        return tuple(arrays.unpack(d) for d in packed[1])
+    return arrays.unpack(packed[1])
+
+
+def is_factory(part):
+    '''
+    a class or a function building the part rather than a part
+    '''
+    return isinstance(part, type) or (callable(part) and not hasattr(part, 'run'))
+
+
+def serve_part(part, conn):
+    '''
+    loop of the part process: build the part when given a factory, then run
+    it for every request of the vehicle
+    '''
+    #the vehicle handles ctrl-c and asks for shutdown
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    arrays = SharedArrays()
+    try:
+        try:
+            if is_factory(part):
+                part = part()
+        except Exception:
+            conn.send(('error', traceback.format_exc()))
+            return
+        conn.send(('ready', part.__class__.__name__))
+
+        while True:
+            try:
+                msg = conn.recv()
+            except EOFError:
+                break
+
+            if msg[0] == 'shutdown':
+                if hasattr(part, 'shutdown'):
+                    part.shutdown()
+                conn.send(('ok', None))
+                break
+
+            try:
+                args = [arrays.unpack(d) for d in msg[1]]
+                outputs = part.run(*args)
+                conn.send(('ok', pack_outputs(arrays, outputs)))
+            except Exception:
+                conn.send(('error', traceback.format_exc()))
+    finally:
+        arrays.close()
+        conn.close()
+
+
+class ProcessPart:
+    '''
+    Wraps a part so its `run` method executes in a separate process.
+
+    `part` is either a part, pickled to the new process, or a factory (a
+    class, or a function without a `run` method) called in the new process
+    to build the part. The part lives in that process from then on; the
+    constructor waits until it is built and raises when building fails.
+
+    The process is started with `start_method`, 'spawn' by default, so the
+    part and factory must be picklable: a lambda or a locally defined
+    function won't do, use a class, a module level function or a
+    functools.partial.
+
+    Calls to `run` block until the part process returns, so combine it with
+    a parallel vehicle or triggers to overlap it with other parts. Array
+    outputs are views onto shared memory that stay valid until the part
+    has run twice more.
+    '''
+
+    def __init__(self, part, shutdown_timeout=5.0, start_method='spawn'):
+        #both processes must share one resource tracker, or each one
+        #reports the blocks created by the other as leaked.
+        resource_tracker.ensure_running()
+        ctx = mp.get_context(start_method)
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(target=serve_part, args=(part, child_conn))
+        self.process.daemon = True
+        self.process.start()
+        child_conn.close()
+        self.arrays = SharedArrays()
+        self.shutdown_timeout = shutdown_timeout
+        self.name = getattr(part, '__name__', part.__class__.__name__)
+
+        try:
+            status, result = self.conn.recv()
+        except EOFError:
+            status, result = 'error', 'the part process exited'
+        if status == 'error':
+            self.process.join(self.shutdown_timeout)
+            self.conn.close()
+            raise RuntimeError('{} failed to start in its process:\n{}'.format(self.name, result))
+        self.name = result
+
+    def run(self, *args):
+        self.conn.send(('run', [self.arrays.pack(i, a) for i, a in enumerate(args)]))
+        status, result = self.conn.recv()
+        if status == 'error':
+            raise RuntimeError('{} failed in its process:\n{}'.format(self.name, result))
+        return unpack_outputs(self.arrays, result)
+
+    def shutdown(self):
+        if not self.process.is_alive():
+            self.arrays.close()
+            return
+        try:
+            self.conn.send(('shutdown',))
+            if self.conn.poll(self.shutdown_timeout):
+                self.conn.recv()
+        except (EOFError, BrokenPipeError):
+            pass
+        self.process.join(self.shutdown_timeout)
+        if self.process.is_alive():
+            self.process.terminate()
+        self.conn.close()
+        self.arrays.close()
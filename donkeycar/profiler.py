@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+profiler.py
+
+Timing of the parts in the vehicle drive loop.
+"""
+
+import math
+from collections import deque, OrderedDict
+
+
+class PartProfiler:
+    """
+    Collects wall time samples (in seconds) for each part of the drive loop.
+
+    Samples are kept per part and per phase ('get' for reading memory,
+    'run' for the part call and 'put' for writing memory) in a rolling window
+    of the last `window` ticks so the percentiles follow the current
+    behaviour of the car rather than the whole session.
+    """
+
+    PHASES = ('get', 'run', 'put')
+
+    def __init__(self, window=1000):
+        self.window = window
+        self.samples = {}
+        self.counts = {}
+        self.names = []
+
+    def record(self, name, phase, elapsed):
+        key = (name, phase)
+        samples = self.samples.get(key)
+        if samples is None:
+            samples = self.samples[key] = deque(maxlen=self.window)
+            self.counts[key] = 0
+            if name not in self.names:
+                self.names.append(name)
+        samples.append(elapsed)
+        self.counts[key] += 1
+
+    def reset(self):
+        self.samples = {}
+        self.counts = {}
+        self.names = []
+
+    @staticmethod
+    def percentile(sorted_samples, p):
+        '''
+        nearest rank percentile of an already sorted list
+        '''
+        if not sorted_samples:
+            return 0.0
+        rank = int(math.ceil(p / 100.0 * len(sorted_samples))) - 1
+        return sorted_samples[min(max(rank, 0), len(sorted_samples) - 1)]
+
+    def stats(self):
+        '''
+        returns an ordered dict of part name -> phase -> statistics, times
+        in seconds, in the order the parts were first recorded
+        '''
+        result = OrderedDict()
+        for name in self.names:
+            phases = OrderedDict()
+            for phase in self.PHASES:
+                samples = self.samples.get((name, phase))
+                if not samples:
+                    continue
+                s = sorted(samples)
+                phases[phase] = {'count': self.counts[(name, phase)],
+                                 'p50': self.percentile(s, 50),
+                                 'p95': self.percentile(s, 95),
+                                 'p99': self.percentile(s, 99),
+                                 'max': s[-1]}
+            result[name] = phases
+        return result
+
+    def report(self):
+        '''
+        returns the statistics as a printable table, times in milliseconds
+        '''
+        header = '{:<32} {:<4} {:>8} {:>9} {:>9} {:>9} {:>9}'
+        row = '{:<32} {:<4} {:>8d} {:>9.3f} {:>9.3f} {:>9.3f} {:>9.3f}'
+        lines = [header.format('part', 'ph', 'count', 'p50 ms', 'p95 ms', 'p99 ms', 'max ms')]
+        for name, phases in self.stats().items():
+            for phase, st in phases.items():
+                lines.append(row.format(name[:32], phase, st['count'],
+                                        st['p50'] * 1000, st['p95'] * 1000,
+                                        st['p99'] * 1000, st['max'] * 1000))
+        return '\n'.join(lines)
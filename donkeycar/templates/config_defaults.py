@@ -39,9 +39,24 @@ THROTTLE_FORWARD_PWM = 388
 THROTTLE_STOPPED_PWM = 360
 THROTTLE_REVERSE_PWM = 327
 
+#TUB
+#'files' saves a json file and a jpg per record, 'packed' appends them to a few large files
+TUB_FORMAT = 'files'
+#records waiting for the writer thread, 0 writes them in the drive loop
+TUB_QUEUE_SIZE = 100
+#with a full queue drop the 'oldest' or 'newest' record, or 'block' the drive loop
+TUB_DROP_POLICY = 'oldest'
+
 #TRAINING
 BATCH_SIZE = 128
 TRAIN_TEST_SPLIT = 0.8
+#threads (processes with TRAIN_USE_PROCESSES) assembling batches, 0 assembles them in the training loop
+TRAIN_WORKERS = 4
+#batches assembled ahead, None for twice the workers
+TRAIN_PREFETCH = None
+TRAIN_USE_PROCESSES = False
+#seed of the batch order, None for a different order every run
+TRAIN_SEED = None
 
 
 #JOYSTICK
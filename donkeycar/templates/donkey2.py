@@ -142,7 +142,8 @@ def drive(cfg, model_path=None, use_joystick=False, use_fuzzy=False):
     types=['image_array', 'float', 'float', 'float', 'float', 'float', 'str']
     
     th = TubHandler(path=cfg.DATA_PATH)
-    tub = th.new_tub_writer(inputs=inputs, types=types)
+    tub = th.new_tub_writer(inputs=inputs, types=types, format=cfg.TUB_FORMAT,
+                            queue_size=cfg.TUB_QUEUE_SIZE, drop_policy=cfg.TUB_DROP_POLICY)
     V.add(tub, inputs=inputs, run_condition='recording')
     
     #run the vehicle
@@ -164,15 +165,19 @@ def train(cfg, tub_names, model_name):
         record['user/angle'] = dk.utils.linear_bin(record['user/angle'])
         return record
 
-    kl = KerasFuzzyAndUltrasonicSensors()
     print('tub_names', tub_names)
     if not tub_names:
         tub_names = os.path.join(cfg.DATA_PATH, '*')
     tubgroup = TubGroup(tub_names)
     train_gen, val_gen = tubgroup.get_train_val_gen(X_keys, y_keys, record_transform=rt,
                                                     batch_size=cfg.BATCH_SIZE,
-                                                    train_frac=cfg.TRAIN_TEST_SPLIT)
+                                                    train_frac=cfg.TRAIN_TEST_SPLIT,
+                                                    workers=cfg.TRAIN_WORKERS,
+                                                    prefetch=cfg.TRAIN_PREFETCH,
+                                                    use_processes=cfg.TRAIN_USE_PROCESSES,
+                                                    seed=cfg.TRAIN_SEED)
 
+    kl = KerasFuzzyAndUltrasonicSensors()
     model_path = os.path.expanduser(model_name)
 
     total_records = len(tubgroup.df)
@@ -0,0 +1,10 @@
+from donkeycar.benchmark import run_benchmark, format_report
+
+
+def test_benchmark():
+    results = run_benchmark(loops=20)
+    assert results['loops'] == 21
+    assert results['rate_hz'] > 0
+    assert 'Obstacle' in results['parts']
+    assert results['allocations']['peak_bytes'] >= 0
+    assert 'Hz' in format_report(results)
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+from donkeycar.clock import LoopClock
+
+
+class FakeTime:
+    def __init__(self):
+        self.now = 0.0
+
+    def clock(self):
+        return self.now
+
+    def sleep(self, t):
+        self.now += t
+
+
+def make_clock(rate_hz=10):
+    t = FakeTime()
+    return t, LoopClock(rate_hz, clock=t.clock, sleep=t.sleep)
+
+
+def test_deadlines_do_not_drift():
+    t, clock = make_clock()
+    clock.start()
+    for _ in range(10):
+        t.now += 0.03
+        clock.wait()
+    assert abs(t.now - 1.0) < 1e-9
+    assert clock.overruns == 0
+
+
+def test_overrun_and_skipped_ticks():
+    t, clock = make_clock()
+    clock.start()
+    t.now += 0.25
+    clock.wait()
+    assert clock.overruns == 1
+    assert clock.skipped == 1
+    #the next deadline is back on the 10Hz grid
+    clock.wait()
+    assert abs(t.now - 0.3) < 1e-9
+
+
+def test_stats():
+    t, clock = make_clock()
+    clock.start()
+    t.now += 0.15
+    clock.wait()
+    stats = clock.stats()
+    assert stats['ticks'] == 1
+    assert abs(stats['jitter_max'] - 0.05) < 1e-9
+
+
+def test_unthrottled():
+    t, clock = make_clock(None)
+    clock.start()
+    for i in range(3):
+        t.now += 0.5
+        clock.wait()
+    clock.stop()
+    t.now += 10
+    stats = clock.stats()
+    assert stats['elapsed'] == 1.5
+    assert stats['overruns'] == 0
+    assert stats['rate_hz'] == 2.0
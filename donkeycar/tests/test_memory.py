@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+import pytest
+from donkeycar.memory import Memory, SlotMemory
+
+
+@pytest.fixture(params=[Memory, SlotMemory])
+def mem(request):
+    return request.param()
+
+
+def test_string_api(mem):
+    mem['a'] = 1
+    mem.put(['b', 'c'], (2, 3))
+    mem.put(['d'], (4, 5))
+    assert mem.get(['a', 'b', 'c', 'missing']) == [1, 2, 3, None]
+    assert mem['d'] == (4, 5)
+    assert mem[('a', 'b')] == [1, 2]
+    assert set(mem.keys()) == {'a', 'b', 'c', 'd'}
+
+
+def test_put_too_few_values(mem):
+    with pytest.raises(IndexError):
+        mem.put(['a', 'b'], (1,))
+
+
+def test_slots(mem):
+    slots = mem.resolve(['a', 'b'])
+    mem.put_slots(slots, (1, 2))
+    mem.put_slot(mem.resolve(['c'])[0], 3)
+    assert mem.get_slots(slots) == [1, 2]
+    assert mem.get(['a', 'b', 'c']) == [1, 2, 3]
+
+
+def test_slot_memory_resolves_once():
+    mem = SlotMemory()
+    assert mem.resolve(['a', 'b']) == (0, 1)
+    assert mem.resolve(['b', 'c']) == (1, 2)
+    assert mem.get_slots((2,)) == [None]
+    mem.update({'c': 5})
+    assert mem.d == {'a': None, 'b': None, 'c': 5}
+
+
+def test_versions(mem):
+    frame = [1, 2, 3]
+    assert mem.get_seq('cam') == 0
+    assert mem.age('cam') is None
+    mem.put(['cam'], frame)
+    mem.put(['cam'], frame)
+    assert mem.get_seq('cam') == 1
+    mem.put(['cam'], list(frame))
+    assert mem.get_seq('cam') == 2
+    assert mem.age('cam') >= 0
+    assert mem.get_seqs(mem.resolve(['cam', 'other'])) == (2, 0)
@@ -0,0 +1,44 @@
+import pytest
+from donkeycar.metrics import Registry
+
+
+def test_counter_and_gauge():
+    r = Registry()
+    c = r.counter('frames_total', 'Frames', {'camera': 'front'})
+    c.inc()
+    c.inc(2)
+    assert r.counter('frames_total', labels={'camera': 'front'}) is c
+    g = r.gauge('depth')
+    g.set(5)
+    g.dec()
+    text = r.render()
+    assert '# HELP frames_total Frames' in text
+    assert '# TYPE frames_total counter' in text
+    assert 'frames_total{camera="front"} 3.0' in text
+    assert 'depth 4.0' in text
+
+
+def test_function():
+    r = Registry()
+    r.gauge('rate_hz').set_function(lambda: 20)
+    assert 'rate_hz 20.0' in r.render()
+
+
+def test_histogram():
+    r = Registry()
+    h = r.histogram('latency_seconds', buckets=(0.1, 1.0))
+    for v in (0.05, 0.1, 0.5, 3):
+        h.observe(v)
+    lines = r.render().splitlines()
+    assert 'latency_seconds_bucket{le="0.1"} 2.0' in lines
+    assert 'latency_seconds_bucket{le="1.0"} 3.0' in lines
+    assert 'latency_seconds_bucket{le="+Inf"} 4.0' in lines
+    assert 'latency_seconds_sum 3.65' in lines
+    assert 'latency_seconds_count 4.0' in lines
+
+
+def test_kind_conflict():
+    r = Registry()
+    r.counter('x')
+    with pytest.raises(ValueError):
+        r.gauge('x', labels={'a': 1})
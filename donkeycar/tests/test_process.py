@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pytest
+import donkeycar as dk
+from donkeycar.parts.transform import Lambda
+
+#shared memory blocks need Python 3.8
+pytest.importorskip('multiprocessing.shared_memory')
+from donkeycar.process import ProcessPart
+
+
+class Brighter:
+    def run(self, img, amount):
+        return img + amount, amount * 2
+
+    def shutdown(self):
+        pass
+
+
+class Broken:
+    def run(self):
+        raise ValueError('broken part')
+
+
+def test_process_part_arrays():
+    p = ProcessPart(Brighter())
+    img = np.zeros((120, 160, 3), dtype=np.uint8)
+    out, amount = p.run(img, 3)
+    assert out.shape == img.shape
+    assert out.dtype == np.uint8
+    assert out[0, 0, 0] == 3
+    assert amount == 6
+    out2, _ = p.run(out, 1)
+    assert out[0, 0, 0] == 3
+    assert out2[0, 0, 0] == 4
+    p.shutdown()
+    assert not p.process.is_alive()
+
+
+def test_process_part_error():
+    p = ProcessPart(Broken())
+    with pytest.raises(RuntimeError):
+        p.run()
+    p.shutdown()
+
+
+class Scaled:
+    def __init__(self, scale):
+        self.scale = scale
+
+    def run(self, img):
+        return img * self.scale
+
+
+def test_process_part_factory():
+    import functools
+    p = ProcessPart(functools.partial(Scaled, 3))
+    assert p.name == 'Scaled'
+    assert p.run(np.ones(2))[0] == 3
+    p.shutdown()
+
+    with pytest.raises(RuntimeError, match='failed to start'):
+        ProcessPart(functools.partial(Scaled, 1, 2))
+
+
+def test_vehicle_process_part():
+    v = dk.Vehicle()
+    v.add(Lambda(lambda: np.ones((4, 4))), outputs=['img'])
+    v.add(Brighter(), inputs=['img', 'amount'], outputs=['out', 'amount2'], process=True)
+    v.mem['amount'] = 1
+    v.update_parts()
+    assert v.mem['out'][0, 0] == 2
+    assert v.parts[1]['name'] == 'Brighter'
+    v.stop()
+
+
+def test_vehicle_process_part_factory():
+    import functools
+    v = dk.Vehicle()
+    v.add(functools.partial(Scaled, 2), inputs=['img'], outputs=['out'], process=True)
+    v.mem['img'] = np.ones(3)
+    v.update_parts()
+    assert v.mem['out'][0] == 2
+    assert v.parts[0]['name'] == 'Scaled'
+    v.stop()
+
+
+def test_process_and_threaded():
+    v = dk.Vehicle()
+    with pytest.raises(ValueError):
+        v.add(Brighter(), process=True, threaded=True)
@@ -1,8 +1,10 @@
 # -*- coding: utf-8 -*-
 import tempfile
 import unittest
-from donkeycar.parts.datastore import TubWriter, Tub
+from donkeycar.parts.datastore import TubWriter, Tub, convert_tub
 import os
+import json
+import numpy as np
 
 import pytest
 
@@ -34,6 +36,50 @@ def test_tub_add_record(tub):
     assert rec_in.keys() == rec_out.keys()
 
 
+def test_tub_manifest(tub, tub_path):
+    """Tub lists its records from the manifest and appends new ones."""
+    tub.shutdown()
+    with open(os.path.join(tub_path, 'manifest.txt')) as fp:
+        assert fp.read().split() == [str(i) for i in range(1, 11)]
+    t = Tub(tub_path)
+    assert t.current_ix == 11
+    t.remove_record(3)
+    assert t.get_num_records() == 9
+    assert 3 not in t.get_index()
+
+
+def test_tub_manifest_rebuild(tub, tub_path):
+    """Readers list a tub without a valid manifest, its writer rebuilds it."""
+    tub.shutdown()
+    manifest = os.path.join(tub_path, 'manifest.txt')
+    os.remove(manifest)
+    assert Tub(tub_path).get_index(shuffled=False) == list(range(1, 11))
+    assert not os.path.exists(manifest)
+    assert Tub(tub_path).create_manifest()
+    assert Tub(tub_path).read_manifest() == list(range(1, 11))
+    with open(manifest, 'w') as fp:
+        fp.write('1\n2\n3')
+    #an existing manifest is not replaced
+    assert not Tub(tub_path).create_manifest()
+    assert not [f for f in os.listdir(tub_path) if f.endswith('.tmp')]
+    with open(manifest) as fp:
+        assert fp.read() == '1\n2\n3'
+    assert Tub(tub_path).get_num_records() == 10
+
+    t = Tub(tub_path)
+    ix = t.put_record({'cam/image_array': np.zeros((120, 160, 3)), 'angle': 1.0, 'throttle': 0.5})
+    t.shutdown()
+    with open(manifest) as fp:
+        assert fp.read().split() == [str(i) for i in list(range(1, 11)) + [ix]]
+
+    os.remove(tub.get_json_record_path(5))
+    t = Tub(tub_path)
+    t.update_df()
+    assert len(t.df) == 10
+    t.check(fix=True)
+    assert 5 not in t.get_index()
+
+
 
 
 class TestTubWriter(unittest.TestCase):
@@ -58,3 +104,229 @@ class TestTubWriter(unittest.TestCase):
 
         assert abs_record_dict['file_path'] == os.path.join(self.path, rel_file_name)
 
+
+
+def test_packed_tub(tub, tub_path, tmpdir):
+    """A tub converted to the packed format returns the same records."""
+    packed_path = str(tmpdir.join('packed'))
+    convert_tub(tub_path, packed_path)
+    with open(os.path.join(packed_path, 'meta.json')) as fp:
+        assert json.load(fp)['format'] == 'packed'
+    assert not [f for f in os.listdir(packed_path) if f.endswith('.jpg')]
+
+    t = Tub(packed_path)
+    assert t.get_index(shuffled=False) == tub.get_index(shuffled=False)
+    for ix in (1, 10):
+        a = tub.get_record(ix)
+        b = t.get_record(ix)
+        assert a['angle'] == b['angle']
+        assert (a['cam/image_array'] == b['cam/image_array']).all()
+
+    ix = t.put_record({'cam/image_array': np.zeros((120, 160, 3)), 'angle': 1.0, 'throttle': 0.5})
+    t.remove_record(2)
+    t.shutdown()
+    t = Tub(packed_path)
+    assert t.get_num_records() == 10
+    assert t.get_record(ix)['throttle'] == 0.5
+    t.update_df()
+    assert t.read_record(t.df.iloc[0].to_dict())['cam/image_array'].shape == (120, 160, 3)
+
+    #readers skip a partial index entry and read a missing index from the
+    #log, the writer rewrites it
+    index_path = os.path.join(packed_path, 'records.idx')
+    with open(index_path, 'ab') as fp:
+        fp.write(b'\0')
+    assert Tub(packed_path).get_index(shuffled=False) == t.get_index(shuffled=False)
+    os.remove(index_path)
+    t = Tub(packed_path)
+    assert t.get_index(shuffled=False) == Tub(packed_path).get_index(shuffled=False)
+    assert not os.path.exists(index_path)
+    ix = t.put_record({'cam/image_array': np.zeros((120, 160, 3)), 'angle': 1.0, 'throttle': 0.5})
+    t.shutdown()
+    assert os.path.getsize(index_path) % 24 == 0
+    assert ix in Tub(packed_path).get_index()
+
+
+def test_tub_writer_queue(tmpdir):
+    """Queued records are written by the writer thread, a full queue drops records."""
+    import threading
+
+    class PausedWriter(TubWriter):
+        def __init__(self, *args, **kwargs):
+            self.go = threading.Event()
+            super(PausedWriter, self).__init__(*args, **kwargs)
+
+        def write_queued(self):
+            self.go.wait()
+            super(PausedWriter, self).write_queued()
+
+    for policy, expected in (('oldest', [8.0, 9.0]), ('newest', [0.0, 1.0])):
+        path = str(tmpdir.join(policy))
+        tub = PausedWriter(path, inputs=['angle'], types=['float'], queue_size=2, drop_policy=policy)
+        for i in range(10):
+            tub.run(float(i))
+        tub.go.set()
+        tub.shutdown()
+
+        t = Tub(path)
+        assert [t.get_record(ix)['angle'] for ix in t.get_index(shuffled=False)] == expected
+
+
+def test_tub_cache(tub, tub_path):
+    """Batches come from the decoded image cache until the tub changes."""
+    from donkeycar.parts.datastore import TubCache, TubGroup
+    cache = TubCache(tub)
+    assert not cache.load()
+    assert cache.build() == 10
+
+    assert cache.load()
+    images = cache.arrays['cam/image_array']
+    assert images.dtype == np.uint8 and images.shape == (10, 120, 160, 3)
+    assert (images[3] == tub.get_record(cache.meta['index'][3])['cam/image_array']).all()
+
+    tub.update_df()
+    rows = tub.get_cache_rows()['cam/image_array']
+    assert len(rows) == 10
+    batch = next(tub.get_batch_gen(['cam/image_array', 'angle'], batch_size=4))
+    assert batch['cam/image_array'].shape == (4, 120, 160, 3)
+    group = TubGroup(tub_path)
+    batch = next(group.get_batch_gen(['cam/image_array'], batch_size=4))
+    assert batch['cam/image_array'].shape == (4, 120, 160, 3)
+
+    tub.put_record({'cam/image_array': np.zeros((120, 160, 3)), 'angle': 1.0, 'throttle': 0.5})
+    assert not TubCache(Tub(tub_path)).load()
+    assert Tub(tub_path).get_cache_rows() == {}
+
+
+def test_tub_cache_without_manifest(tub, tub_path):
+    """The first build of a tub without manifest loads."""
+    from donkeycar.parts.datastore import TubCache
+    tub.shutdown()
+    os.remove(os.path.join(tub_path, 'manifest.txt'))
+    cache = TubCache(Tub(tub_path))
+    assert cache.build() == 10
+    assert TubCache(Tub(tub_path)).load()
+
+
+def test_tub_record_gen_epochs(tub):
+    """Every record is generated once per epoch, from the given df."""
+    tub.update_df()
+    gen = tub.get_record_gen(df=tub.df, chunk_size=3)
+    for _ in range(2):
+        epoch = [next(gen) for _ in range(10)]
+        assert sorted(r['angle'] for r in epoch) == sorted(tub.df['angle'])
+        assert epoch[0]['cam/image_array'].shape == (120, 160, 3)
+
+    half = tub.df.iloc[:4]
+    gen = tub.get_record_gen(df=half, shuffle=False, read_images=False)
+    assert [next(gen)['angle'] for _ in range(8)] == list(half['angle']) * 2
+
+
+def test_tub_batch_buffers(tub):
+    """Batches are new arrays unless buffers are reused."""
+    tub.update_df()
+    keys = ['cam/image_array', 'angle']
+    gen = tub.get_batch_gen(keys, batch_size=4)
+    a, b = next(gen), next(gen)
+    assert a['cam/image_array'].shape == (4, 120, 160, 3)
+    assert a['cam/image_array'].dtype == np.uint8
+    assert a['angle'].shape == (4,)
+    assert a['cam/image_array'] is not b['cam/image_array']
+
+    gen = tub.get_batch_gen(keys, batch_size=4, num_buffers=2)
+    batches = [next(gen) for _ in range(3)]
+    assert batches[0]['cam/image_array'] is not batches[1]['cam/image_array']
+    assert batches[0]['cam/image_array'] is batches[2]['cam/image_array']
+
+
+def angle_transform(record):
+    record['angle'] = record['angle'] * 2
+    return record
+
+
+@pytest.mark.parametrize('use_processes', [False, True])
+def test_tub_loader(tub, use_processes):
+    """The loader's batches depend on the seed, not on the workers."""
+    from donkeycar.parts.datastore import TubLoader
+    tub.update_df()
+    dfs = {'train': tub.df.iloc[:7], 'val': tub.df.iloc[7:]}
+
+    def batches(workers, **kwargs):
+        loader = TubLoader(tub, dfs, batch_size=4, record_transform=angle_transform,
+                           workers=workers, seed=1, **kwargs)
+        gen = loader.get_train_gen('train', ['cam/image_array'], ['angle'])
+        result = [next(gen) for _ in range(7)]
+        loader.shutdown()
+        return result
+
+    serial = batches(0)
+    parallel = batches(3, prefetch=2, use_processes=use_processes)
+    for (X0, Y0), (X1, Y1) in zip(serial, parallel):
+        assert X1[0].shape == (4, 120, 160, 3)
+        assert (X0[0] == X1[0]).all() and (Y0[0] == Y1[0]).all()
+    #the seed of a df doesn't depend on the order of dfs
+    loader = TubLoader(tub, {'val': dfs['val'], 'train': dfs['train']}, batch_size=4,
+                       record_transform=angle_transform, workers=0, seed=1)
+    gen = loader.get_train_gen('train', ['cam/image_array'], ['angle'])
+    assert all((Y[0] == next(gen)[1][0]).all() for _, Y in serial)
+
+    #7 batches of 4 are 4 epochs of the 7 records
+    angles = np.concatenate([Y[0] for _, Y in serial])
+    assert sorted(angles) == sorted(list(tub.df['angle'].iloc[:7] * 2) * 4)
+
+    train_gen, val_gen = tub.get_train_val_gen(['cam/image_array'], ['angle'],
+                                               batch_size=2, workers=2)
+    X, Y = next(val_gen)
+    assert X[0].shape == (2, 120, 160, 3)
+    #closing either generator shuts down the shared workers
+    val_gen.close()
+    with pytest.raises(RuntimeError, match='shut down'):
+        next(train_gen)
+
+
+def test_tub_df_cache(tub, tub_path, tmpdir):
+    """The parsed records are cached and only new records are parsed."""
+    from donkeycar.parts.datastore import TubGroup
+    from donkeycar.tests.setup import create_sample_tub
+    tub.update_df()
+    assert os.path.exists(os.path.join(tub_path, 'cache', 'records.pkl'))
+
+    t = Tub(tub_path)
+    parsed = []
+    get_json_record = t.get_json_record
+    t.get_json_record = lambda ix: parsed.append(ix) or get_json_record(ix)
+    t.update_df()
+    assert parsed == [] and t.df.equals(tub.df)
+
+    ix = t.put_record({'cam/image_array': np.zeros((120, 160, 3)), 'angle': 1.0, 'throttle': 0.5})
+    t.remove_record(1)
+    t.update_df()
+    assert parsed == [ix]
+    assert len(t.df) == 10 and t.df['throttle'].iloc[-1] == 0.5
+
+    other_path = str(tmpdir.join('other'))
+    create_sample_tub(other_path, records=5)
+    group = TubGroup(','.join([tub_path, other_path]), workers=2)
+    assert len(group.df) == 15
+
+
+def test_tub_stacker_cache(tub, tub_path):
+    """A pass over the stacked records decodes every frame once."""
+    from donkeycar.parts.datastore import TubImageStacker, TubTimeStacker
+    t = TubImageStacker(tub_path)
+    index = t.get_index(shuffled=False)
+    #the records with two previous ones
+    for ix in index[2:]:
+        record = t.get_record(ix)
+    assert record['cam/image_array'].shape == (120, 160, 3)
+    stats = t.cache_stats()
+    assert stats['frames']['misses'] == len(index)
+    assert stats['frames']['hits'] == 2 * (len(index) - 3)
+
+    t = TubTimeStacker([0, 1], tub_path, json_cache_size=4)
+    record = t.get_record(index[0])
+    assert record['angle_1'] == tub.get_json_record(index[1])['angle']
+    assert (record['cam/image_array'] == tub.get_record(index[0])['cam/image_array']).all()
+    t.get_record(index[1])
+    #records 1, 2 and 3 parsed once
+    assert t.cache_stats()['json']['misses'] == 3
@@ -1,3 +1,4 @@
+import time
 import pytest
 import donkeycar as dk
 from donkeycar.parts.transform import Lambda
@@ -24,6 +25,358 @@ def test_add_part():
     assert len(v.parts) == 1
 
 
+def test_process_part_needs_python_38(monkeypatch):
+    import sys
+    monkeypatch.setattr(sys, 'version_info', (3, 7, 0))
+    v = dk.Vehicle()
+    with pytest.raises(RuntimeError, match='Python 3.8'):
+        v.add(Lambda(lambda: 1), outputs=['test_out'], process=True)
+    assert len(v.parts) == 0
+
+
 def test_vehicle_run(vehicle):
     vehicle.start(rate_hz=20, max_loop_count=2)
-    assert vehicle is not None
\ No newline at end of file
+    assert vehicle is not None
+
+def test_part_names_are_unique():
+    v = dk.Vehicle()
+    v.add(Lambda(lambda: 1), outputs=['a'])
+    v.add(Lambda(lambda: 2), outputs=['b'])
+    assert [e['name'] for e in v.parts] == ['Lambda', 'Lambda_2']
+
+
+def test_vehicle_profile():
+    v = dk.Vehicle(profile=True)
+    v.add(Lambda(lambda: 1), outputs=['test_out'])
+    v.add(Lambda(lambda x: x), inputs=['test_out'], outputs=['test_copy'])
+    for _ in range(5):
+        v.update_parts()
+    stats = v.profiler.stats()
+    assert list(stats.keys()) == ['Lambda', 'Lambda_2']
+    assert stats['Lambda']['run']['count'] == 5
+    assert stats['Lambda_2']['get']['max'] >= stats['Lambda_2']['get']['p50']
+    assert 'Lambda_2' in v.profile_report()
+
+
+def test_profile_report_disabled(vehicle):
+    assert vehicle.profile_report() is None
+
+
+def test_stages_follow_channel_dependencies():
+    v = dk.Vehicle(parallel=True)
+    v.add(Lambda(lambda: 1), outputs=['a'])
+    v.add(Lambda(lambda: 2), outputs=['b'])
+    v.add(Lambda(lambda a, b: a + b), inputs=['a', 'b'], outputs=['c'])
+    v.add(Lambda(lambda: 3), outputs=['d'])
+    v.add(Lambda(lambda: 4), outputs=['a'])
+    assert [e['stage'] for e in v.parts] == [0, 0, 1, 0, 2]
+
+
+def test_vehicle_parallel_run():
+    v = dk.Vehicle(parallel=True)
+    v.add(Lambda(lambda: 1), outputs=['a'])
+    v.add(Lambda(lambda: 2), outputs=['b'])
+    v.add(Lambda(lambda a, b: a + b), inputs=['a', 'b'], outputs=['c'])
+    v.update_parts()
+    assert v.mem['c'] == 3
+    v.stop()
+
+
+def test_part_every():
+    v = dk.Vehicle()
+    calls = []
+    v.add(Lambda(lambda: calls.append(1)), every=3)
+    for _ in range(7):
+        v.update_parts()
+    assert len(calls) == 3
+
+
+def test_part_rate_hz():
+    v = dk.Vehicle()
+    v.add(Lambda(lambda: 1), outputs=['a'], rate_hz=5)
+    v.add(Lambda(lambda: 1), outputs=['b'], rate_hz=50)
+    v.set_part_rates(20)
+    assert [e['every'] for e in v.parts] == [4, 1]
+
+
+def test_compiled_part_binds_run_method():
+    class Part:
+        def run(self):
+            return 'run'
+        def run_threaded(self):
+            return 'run_threaded'
+        def update(self):
+            pass
+
+    v = dk.Vehicle()
+    v.add(Part(), outputs=['a'])
+    v.add(Part(), outputs=['b'], threaded=True)
+    v.update_parts()
+    assert v.mem['a'] == 'run'
+    assert v.mem['b'] == 'run_threaded'
+    assert v.records[1].inputs == ()
+
+
+def test_skip_unchanged():
+    v = dk.Vehicle()
+    frames = [object()]
+    calls = []
+    v.add(Lambda(lambda: frames[-1]), outputs=['cam'])
+    v.add(Lambda(lambda f: calls.append(f)), inputs=['cam'], skip_unchanged=True)
+    v.update_parts()
+    v.update_parts()
+    assert len(calls) == 1
+    frames.append(object())
+    v.update_parts()
+    assert len(calls) == 2
+
+
+def test_triggered_part():
+    import threading
+    v = dk.Vehicle()
+    done = threading.Event()
+    v.add(Lambda(lambda: 1), outputs=['cam'])
+    v.add(Lambda(lambda x: done.set()), inputs=['cam'], triggers=['cam'])
+    assert v.parts[1]['stage'] is None
+    v.start_triggered()
+    v.update_parts()
+    assert done.wait(1)
+    v.stop()
+
+
+@pytest.mark.parametrize('async_loop', [False, True])
+def test_triggered_part_error(async_loop):
+    from donkeycar.async_vehicle import AsyncVehicle
+    v = AsyncVehicle() if async_loop else dk.Vehicle()
+    def pilot(x):
+        raise RuntimeError('pilot failed')
+    v.add(Lambda(lambda: object()), outputs=['cam'])
+    v.add(Lambda(pilot), inputs=['cam'], outputs=['pilot/angle'], triggers=['cam'])
+    with pytest.raises(RuntimeError, match='pilot failed'):
+        v.start(rate_hz=20, max_loop_count=100)
+    assert not v.on
+
+
+def test_async_vehicle():
+    import asyncio
+
+    class Poller:
+        def __init__(self):
+            self.count = 0
+            self.on = True
+
+        def update(self):
+            raise AssertionError('update_async should be used')
+
+        async def update_async(self):
+            while self.on:
+                self.count += 1
+                await asyncio.sleep(0.001)
+
+        def run_threaded(self):
+            return self.count
+
+        def shutdown(self):
+            self.on = False
+
+    class AsyncDouble:
+        async def run_async(self, x):
+            await asyncio.sleep(0)
+            return x * 2
+
+        def run(self, x):
+            raise AssertionError('run_async should be used')
+
+    v = dk.AsyncVehicle()
+    poller = Poller()
+    v.add(poller, outputs=['count'], threaded=True)
+    v.add(AsyncDouble(), inputs=['count'], outputs=['double'])
+    v.start(rate_hz=50, max_loop_count=3)
+    assert poller.count > 0
+    assert v.mem['double'] == 2 * v.mem['count']
+    assert v.records[1].is_async
+
+
+def test_async_vehicle_triggered_part():
+    import asyncio
+    import threading
+
+    class Both:
+        def __init__(self):
+            self.done = threading.Event()
+
+        async def run_async(self, x):
+            raise AssertionError('run should be used')
+
+        def run(self, x):
+            self.done.set()
+            return x
+
+    class AsyncOnly:
+        async def run_async(self, x):
+            return x
+
+    v = dk.AsyncVehicle()
+    both = Both()
+    v.add(Lambda(lambda: 1), outputs=['c'])
+    v.add(both, inputs=['c'], outputs=['d'], triggers=['c'])
+    assert not v.records[1].is_async
+    with pytest.raises(ValueError):
+        v.add(AsyncOnly(), inputs=['c'], outputs=['e'], triggers=['c'])
+    assert len(v.parts) == 2
+    v.start_triggered()
+    v.update_parts()
+    assert both.done.wait(1)
+    v.stop()
+    assert v.mem['d'] == 1
+
+
+def test_wait_until_ready():
+    class Warming:
+        def __init__(self, polls):
+            self.polls = polls
+
+        def ready(self):
+            self.polls -= 1
+            return self.polls <= 0
+
+        def run(self):
+            return 1
+
+    v = dk.Vehicle()
+    v.add(Warming(3), outputs=['a'])
+    v.add(Lambda(lambda: 2), outputs=['b'])
+    assert v.wait_until_ready(timeout=1, poll_delay=0)
+    v.add(Warming(10 ** 9), outputs=['c'])
+    assert not v.wait_until_ready(timeout=0.05)
+    assert v.parts_not_ready() == ['Warming_2']
+
+
+def test_stop_shuts_down_parts_concurrently():
+    class Slow:
+        def __init__(self, delay):
+            self.delay = delay
+            self.done = False
+
+        def run(self):
+            return 1
+
+        def shutdown(self):
+            time.sleep(self.delay)
+            self.done = True
+
+    v = dk.Vehicle()
+    fast = [Slow(0.2) for _ in range(4)]
+    for part in fast:
+        v.add(part, outputs=['x'])
+    v.add(Slow(10), outputs=['y'])
+    start = time.monotonic()
+    timed_out = v.stop(timeout=0.5)
+    assert time.monotonic() - start < 1.0
+    assert all(part.done for part in fast)
+    assert timed_out == ['Slow_5']
+
+
+def test_stale_threaded_output():
+    class Sensor:
+        def __init__(self):
+            self.value = [1.0]
+            self.update_count = 1
+
+        def update(self):
+            pass
+
+        def run_threaded(self):
+            return self.value
+
+    v = dk.Vehicle()
+    sensor = Sensor()
+    v.add(sensor, outputs=['throttle'], threaded=True, max_age=0.05, fallback=0.0)
+    v.update_parts()
+    assert v.mem['throttle'] == [1.0]
+    time.sleep(0.1)
+    v.update_parts()
+    assert v.mem['throttle'] == 0.0
+    sensor.value = [2.0]
+    sensor.update_count += 1
+    v.update_parts()
+    assert v.mem['throttle'] == [2.0]
+
+    stats = v.freshness_stats()['Sensor']
+    assert stats['fresh'] == 2
+    assert stats['stale_ticks'] == 1
+    assert stats['interval_max'] >= 0.1
+
+
+def test_unchanged_threaded_output_is_fresh():
+    """A running update loop keeps an unchanged value fresh."""
+    class Stick:
+        def __init__(self):
+            self.on = True
+            self.update_count = 0
+
+        def update(self):
+            while self.on:
+                self.update_count += 1
+                time.sleep(0.01)
+
+        def run_threaded(self):
+            return 0.5
+
+        def shutdown(self):
+            self.on = False
+
+    class Recorder:
+        def __init__(self):
+            self.values = []
+
+        def run(self, throttle):
+            self.values.append(throttle)
+
+    v = dk.Vehicle()
+    v.add(Stick(), outputs=['throttle'], threaded=True, max_age=0.1, fallback=0.0)
+    recorder = Recorder()
+    v.add(recorder, inputs=['throttle'])
+    v.start(rate_hz=20, max_loop_count=20)
+    assert recorder.values and set(recorder.values) == {0.5}
+    assert v.freshness_stats()['Stick']['stale_ticks'] == 0
+
+    with pytest.raises(ValueError, match='update_count'):
+        v.add(Lambda(lambda: 1), outputs=['x'], threaded=True, max_age=0.5)
+
+
+def test_trace(tmp_path):
+    import json
+
+    class Poller:
+        def __init__(self):
+            self.value = 0
+            self.on = True
+
+        def poll(self):
+            return self.value + 1
+
+        def update(self):
+            while self.on:
+                self.value = self.poll()
+                time.sleep(0.005)
+
+        def run_threaded(self):
+            return self.value
+
+        def shutdown(self):
+            self.on = False
+
+    path = str(tmp_path / 'trace.json')
+    v = dk.Vehicle(trace=path)
+    v.add(Poller(), outputs=['a'], threaded=True)
+    v.add(Lambda(lambda a: a), inputs=['a'], outputs=['b'])
+    v.start(rate_hz=50, max_loop_count=3)
+
+    with open(path) as fp:
+        events = json.load(fp)['traceEvents']
+    names = {e['name'] for e in events}
+    assert {'loop', 'Poller', 'Lambda', 'get', 'put', 'poll', 'sleep', 'thread_name'} <= names
+    threads = {e['args']['name']: e['tid'] for e in events if e['ph'] == 'M'}
+    polls = [e for e in events if e['name'] == 'poll']
+    assert polls[0]['tid'] == threads['Poller update'] != threads['drive loop']
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+trace.py
+
+Record what the vehicle threads do as a Chrome trace, to open in
+chrome://tracing or https://ui.perfetto.dev.
+"""
+
+import os
+import sys
+import json
+import time
+import threading
+
+
+class TraceRecorder:
+    """
+    Collects spans (a name, a category, a start and an end time) with the
+    thread they ran on and writes them in the Chrome trace event format.
+
+    Spans are appended from several threads; list.append is atomic, so no
+    lock is taken. After `max_events` spans new ones are dropped and
+    counted, to bound the memory of a long drive.
+    """
+
+    def __init__(self, path=None, max_events=1000000, clock=time.perf_counter):
+        self.path = path
+        self.max_events = max_events
+        self.clock = clock
+        self.start_time = clock()
+        self.pid = os.getpid()
+        self.events = []
+        self.thread_names = {}
+        self.dropped = 0
+
+    def span(self, name, cat, start, end, args=None):
+        '''
+        add a span that ran on the current thread, start and end from clock
+        '''
+        if len(self.events) >= self.max_events:
+            self.dropped += 1
+            return
+        event = {'name': name, 'cat': cat, 'ph': 'X',
+                 'ts': (start - self.start_time) * 1e6,
+                 'dur': (end - start) * 1e6,
+                 'pid': self.pid, 'tid': threading.get_ident()}
+        if args:
+            event['args'] = args
+        self.events.append(event)
+
+    def name_thread(self, name):
+        '''
+        label the current thread in the trace viewer
+        '''
+        self.thread_names[threading.get_ident()] = name
+
+    def trace_update(self, name, part):
+        '''
+        Returns a thread target running part.update while recording, on
+        that thread only, a span for every call of the part's own methods
+        and of time.sleep, which shows each iteration of its update loop.
+        '''
+        update = part.update
+        codes = set()
+        for cls in type(part).__mro__:
+            if cls is object:
+                continue
+            for value in vars(cls).values():
+                code = getattr(value, '__code__', None)
+                if code is not None:
+                    codes.add(code)
+        codes.discard(getattr(update, '__code__', None))
+        sleep = time.sleep
+        stack = []
+
+        def profile(frame, event, arg):
+            if event == 'call':
+                if frame.f_code in codes:
+                    stack.append((frame.f_code, self.clock()))
+            elif event == 'return':
+                if stack and stack[-1][0] is frame.f_code:
+                    code, start = stack.pop()
+                    self.span(code.co_name, 'update', start, self.clock(), {'part': name})
+            elif event == 'c_call':
+                if arg is sleep:
+                    stack.append((sleep, self.clock()))
+            elif event in ('c_return', 'c_exception'):
+                if arg is sleep and stack and stack[-1][0] is sleep:
+                    _, start = stack.pop()
+                    self.span('sleep', 'update', start, self.clock(), {'part': name})
+
+        def run():
+            self.name_thread('{} update'.format(name))
+            sys.setprofile(profile)
+            try:
+                update()
+            finally:
+                sys.setprofile(None)
+
+        return run
+
+    def to_dict(self):
+        events = [{'name': 'thread_name', 'ph': 'M', 'pid': self.pid, 'tid': tid,
+                   'args': {'name': name}}
+                  for tid, name in self.thread_names.items()]
+        return {'traceEvents': events + list(self.events),
+                'displayTimeUnit': 'ms',
+                'otherData': {'dropped': self.dropped}}
+
+    def save(self, path=None):
+        '''
+        write the trace as json, returns the path written
+        '''
+        path = os.path.expanduser(path or self.path)
+        with open(path, 'w') as fp:
+            json.dump(self.to_dict(), fp)
+        return path
@@ -6,24 +6,119 @@ Created on Sun Jun 25 10:44:24 2017
 @author: wroscoe
 """
 
+import sys
 import time
-from threading import Thread
-from .memory import Memory
+from threading import Thread, Event
+from concurrent.futures import ThreadPoolExecutor
+from .memory import SlotMemory
+from .profiler import PartProfiler
+from .trace import TraceRecorder
+from . import metrics
+from .clock import LoopClock
+
+
+class CompiledPart:
+    '''
+    The parts of a vehicle entry the drive loop needs on every tick, resolved
+    once when the part is added: the method to call and the memory slots of
+    its channels.
+    '''
+    __slots__ = ('name', 'part', 'run', 'inputs', 'outputs', 'condition',
+                 'input_slots', 'output_slots', 'output_slot', 'condition_slot',
+                 'every', 'stage', 'skip_unchanged', 'last_seqs', 'event',
+                 'is_async', 'counts_updates', 'max_age', 'fallback', 'last_count',
+                 'fresh_time', 'fresh_count', 'stale_ticks', 'interval_sum',
+                 'interval_max')
+
+    def __init__(self, entry, mem):
+        self.name = entry['name']
+        self.part = entry['part']
+        if entry.get('thread'):
+            self.run = entry['part'].run_threaded
+        else:
+            self.run = entry['part'].run
+        self.inputs = tuple(entry['inputs'])
+        self.outputs = tuple(entry['outputs'])
+        self.condition = entry['run_condition'] or None
+
+        self.input_slots = mem.resolve(self.inputs)
+        self.output_slots = mem.resolve(self.outputs)
+        #a part with a single output returns the value itself
+        if len(self.outputs) == 1:
+            self.output_slot = self.output_slots[0]
+        else:
+            self.output_slot = None
+        if self.condition:
+            self.condition_slot = mem.resolve((self.condition,))[0]
+        else:
+            self.condition_slot = None
+        self.every = entry['every']
+        self.stage = 0
+        self.skip_unchanged = entry['skip_unchanged']
+        self.last_seqs = None
+        self.event = None
+        self.is_async = False
+
+        #freshness of threaded parts counting their updates in update_count
+        self.counts_updates = bool(entry.get('thread')) and hasattr(self.part, 'update_count')
+        self.max_age = entry.get('max_age')
+        self.fallback = entry.get('fallback')
+        self.last_count = 0
+        self.fresh_time = None
+        self.fresh_count = 0
+        self.stale_ticks = 0
+        self.interval_sum = 0.0
+        self.interval_max = 0.0
 
 
 class Vehicle():
-    def __init__(self, mem=None):
+    def __init__(self, mem=None, profile=False, parallel=False, max_workers=None,
+                 shutdown_timeout=3.0, trace=None):
+        '''
+        profile : boolean
+            Record the time spent by every part and its memory access.
+            See `profile_report`.
+        parallel : boolean
+            Run parts that don't depend on each other's channels at the same
+            time on a thread pool. Parts still run in the order they were added
+            whenever one reads or writes a channel another one writes.
+        max_workers : int
+            Size of the thread pool used when parallel is True.
+        shutdown_timeout : float
+            Seconds `stop` waits for the parts to shut down. The parts shut
+            down at the same time, so this is the time given to each part.
+        trace : str
+            Path of a Chrome trace file to write when the vehicle stops, with
+            the drive loops, part calls, memory gets and puts and the
+            iterations of the threaded parts' update loops.
+        '''
 
         if not mem:
-            mem = Memory()
+            mem = SlotMemory()
         self.mem = mem
         self.parts = []
+        self.records = []
+        self.loop_records = []
+        self.triggered = []
+        #exception of a triggered part, raised by the drive loop
+        self.trigger_error = None
         self.on = True
         self.threads = []
+        self.profiler = PartProfiler() if profile else None
+        self.tracer = TraceRecorder(trace) if trace else None
+        self.parallel = parallel
+        self.max_workers = max_workers
+        self.executor = None
+        self.stages = []
+        self.tick = 0
+        self.clock = None
+        self.shutdown_timeout = shutdown_timeout
 
 
     def add(self, part, inputs=[], outputs=[], 
-            threaded=False, run_condition=None):
+            threaded=False, run_condition=None, rate_hz=None, every=None,
+            skip_unchanged=False, triggers=None, process=False,
+            max_age=None, fallback=None):
         """
         Method to add a part to the vehicle drive loop.
 
@@ -35,25 +130,133 @@ class Vehicle():
                 Channel names to save to memory.
             threaded : boolean
                 If a part should be run in a separate thread.
+            rate_hz : float
+                How often the part should run. It is rounded to a whole
+                number of drive loops when the vehicle starts and can't be
+                faster than the drive loop.
+            every : int
+                Run the part once every `every` drive loops. Ignored if
+                rate_hz is given.
+            skip_unchanged : boolean
+                Don't run the part when none of its inputs changed since it
+                last ran.
+            triggers : list
+                Channel names. The part leaves the drive loop and runs in its
+                own thread as soon as one of these channels changes.
+            process : boolean
+                Run the part in a separate process. Numpy arrays are passed
+                through shared memory. Can't be combined with threaded. The
+                part can then be a factory building it in that process,
+                see ProcessPart. Needs Python 3.8.
+            max_age : float
+                Threaded parts only. Seconds after which the value returned
+                by run_threaded is stale when the update thread hasn't
+                produced a new one. Stale ticks are counted. The part's
+                update loop must increment its `update_count` attribute on
+                every iteration.
+            fallback : object
+                Value saved instead of a stale one, e.g. 0.0 for a throttle,
+                or a tuple with one value per output. When None, stale
+                values are saved as they are.
         """
 
+        if max_age is not None and not (threaded and hasattr(part, 'update_count')):
+            raise ValueError('max_age needs a threaded part counting the iterations '
+                             'of its update loop in update_count.')
+
         p = part
-        print('Adding part {}.'.format(p.__class__.__name__))
+        class_name = p.__class__.__name__
+        if process:
+            if threaded:
+                raise ValueError('A part can not be both threaded and run in a process.')
+            if sys.version_info < (3, 8):
+                raise RuntimeError('Running a part in a process needs Python 3.8 '
+                                   'or newer for multiprocessing.shared_memory.')
+            from .process import ProcessPart
+            p = ProcessPart(p)
+            class_name = p.name
+
+        print('Adding part {}.'.format(class_name))
         entry={}
+        entry['name'] = self.make_part_name(p, class_name)
+
         entry['part'] = p
         entry['inputs'] = inputs
         entry['outputs'] = outputs
         entry['run_condition'] = run_condition
+        entry['rate_hz'] = rate_hz
+        entry['every'] = every or 1
+        entry['skip_unchanged'] = skip_unchanged
+        entry['max_age'] = max_age
+        entry['fallback'] = fallback
 
         if threaded:
-            t = Thread(target=part.update, args=())
+            if self.tracer is not None:
+                target = self.tracer.trace_update(entry['name'], part)
+            else:
+                target = part.update
+            t = Thread(target=target, args=())
             t.daemon = True
             entry['thread'] = t
 
+        record = CompiledPart(entry, self.mem)
+        if triggers:
+            entry['stage'] = None
+            record.event = Event()
+            self.mem.subscribe(self.mem.resolve(triggers), record.event.set)
+            self.triggered.append(record)
+        else:
+            self.add_to_stage(entry, record)
+            self.loop_records.append(record)
         self.parts.append(entry)
+        self.records.append(record)
+
+
+    def add_to_stage(self, entry, record):
+        '''
+        Place a new part in the first stage after every earlier part it
+        depends on. A part depends on an earlier part when it reads a channel
+        that part writes, writes a channel that part reads or both write the
+        same channel. Parts of the same stage can run at the same time.
+        '''
+        reads = set(entry['inputs'])
+        if entry['run_condition']:
+            reads.add(entry['run_condition'])
+        writes = set(entry['outputs'])
+
+        stage = 0
+        for other in self.parts:
+            if other['stage'] is None:
+                continue
+            other_reads = set(other['inputs'])
+            if other['run_condition']:
+                other_reads.add(other['run_condition'])
+            other_writes = set(other['outputs'])
+            if (reads & other_writes) or (writes & other_reads) or (writes & other_writes):
+                stage = max(stage, other['stage'] + 1)
+
+        entry['stage'] = record.stage = stage
+        if stage == len(self.stages):
+            self.stages.append([])
+        self.stages[stage].append(record)
+
+
+    def make_part_name(self, part, name=None):
+        '''
+        unique name of a part, the class name with a suffix when the
+        same class was added more than once.
+        '''
+        name = name or part.__class__.__name__
+        names = [entry['name'] for entry in self.parts]
+        i = 1
+        unique = name
+        while unique in names:
+            i += 1
+            unique = '{}_{}'.format(name, i)
+        return unique
 
 
-    def start(self, rate_hz=10, max_loop_count=None):
+    def start(self, rate_hz=10, max_loop_count=None, ready_timeout=5.0):
         """
         Start vehicle's main drive loop.
 
@@ -67,81 +270,398 @@ class Vehicle():
         rate_hz : int
             The max frequency that the drive loop should run. The actual
             frequency may be less than this if there are many blocking parts.
+            None or 0 runs the loop as fast as possible.
         max_loop_count : int
             Maxiumum number of loops the drive loop should execute. This is
             used for testing the all the parts of the vehicle work.
+        ready_timeout : float
+            Maximum seconds to wait for the parts with a `ready` method to
+            report they are ready before starting the drive loop.
         """
 
         try:
 
             self.on = True
+            self.set_part_rates(rate_hz)
 
             for entry in self.parts:
                 if entry.get('thread'):
                     #start the update thread
                     entry.get('thread').start()
 
+            self.start_triggered()
+
             #wait until the parts warm up.
             print('Starting vehicle...')
-            time.sleep(1)
+            self.wait_until_ready(ready_timeout)
 
             loop_count = 0
+            tracer = self.tracer
+            if tracer is not None:
+                tracer.name_thread('drive loop')
+            self.clock = LoopClock(rate_hz)
+            self.clock.start()
+            self.register_metrics()
             while self.on:
-                start_time = time.time()
                 loop_count += 1
 
-                self.update_parts()
+                if tracer is not None:
+                    t0 = tracer.clock()
+                    self.update_parts()
+                    tracer.span('loop', 'vehicle', t0, tracer.clock(), {'loop': loop_count})
+                else:
+                    self.update_parts()
 
                 #stop drive loop if loop_count exceeds max_loopcount
                 if max_loop_count and loop_count > max_loop_count:
                     self.on = False
 
-                sleep_time = 1.0 / rate_hz - (time.time() - start_time)
-                if sleep_time > 0.0:
-                    time.sleep(sleep_time)
+                self.clock.wait()
 
                 #print('this is the vehicle loop', loop_count)
 
+            self.raise_trigger_error()
+
         except KeyboardInterrupt:
             pass
         finally:
             self.stop()
 
 
+    def parts_not_ready(self):
+        '''
+        names of the parts whose optional `ready` method returns False
+        '''
+        return [entry['name'] for entry in self.parts
+                if hasattr(entry['part'], 'ready') and not entry['part'].ready()]
+
+
+    def wait_until_ready(self, timeout, poll_delay=0.01):
+        '''
+        Wait until every part with a `ready` method reports it is ready, or
+        until timeout seconds passed. All parts are checked on every poll, so
+        they warm up at the same time. Returns True if all parts are ready.
+        '''
+        start = time.monotonic()
+        waiting = self.parts_not_ready()
+        while waiting and time.monotonic() - start < timeout:
+            time.sleep(poll_delay)
+            waiting = self.parts_not_ready()
+
+        if waiting:
+            print('Parts not ready after {:.1f}s: {}'.format(timeout, ', '.join(waiting)))
+        else:
+            print('Parts ready after {:.2f}s.'.format(time.monotonic() - start))
+        return not waiting
+
+
+    def set_part_rates(self, rate_hz):
+        '''
+        convert the rate_hz of the parts to a number of drive loops
+        '''
+        for entry, record in zip(self.parts, self.records):
+            part_hz = entry['rate_hz']
+            if not part_hz:
+                continue
+            if not rate_hz:
+                print('{} asks for {} Hz but the drive loop is unthrottled, '
+                      'it runs on every loop.'.format(entry['name'], part_hz))
+                entry['every'] = record.every = 1
+                continue
+            if part_hz > rate_hz:
+                print('{} asks for {} Hz but the drive loop runs at {} Hz.'.format(
+                    entry['name'], part_hz, rate_hz))
+            entry['every'] = record.every = max(1, int(round(rate_hz / part_hz)))
+
+
     def update_parts(self):
         '''
         loop over all parts
         '''
-        for entry in self.parts:
-            #don't run if there is a run condition that is False
-            run = True
-            if entry.get('run_condition'):
-                run_condition = entry.get('run_condition')
-                run = self.mem.get([run_condition])[0]
-                #print('run_condition', entry['part'], entry.get('run_condition'), run)
-            
-            if run:
-                p = entry['part']
-                #get inputs from memory
-                inputs = self.mem.get(entry['inputs'])
-
-                #run the part
-                if entry.get('thread'):
-                    outputs = p.run_threaded(*inputs)
+        tick = self.tick
+        self.tick += 1
+        if self.profiler or self.tracer:
+            run_part = self.run_part_profiled
+        else:
+            run_part = self.run_part
+
+        if not self.parallel:
+            for record in self.loop_records:
+                if tick % record.every == 0:
+                    run_part(record)
+            return
+
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.max_workers)
+
+        for stage in self.stages:
+            due = [record for record in stage if tick % record.every == 0]
+            if len(due) == 1:
+                run_part(due[0])
+            elif due:
+                futures = [self.executor.submit(run_part, record) for record in due]
+                for f in futures:
+                    #raises the exception of a failed part
+                    f.result()
+
+
+    def start_triggered(self):
+        '''
+        start a thread for every part added with triggers
+        '''
+        self.trigger_error = None
+        for record in self.triggered:
+            t = Thread(target=self.run_triggered, args=(record,))
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+
+    def run_triggered(self, record):
+        '''
+        Run a part every time one of its trigger channels changes. An
+        exception of the part stops the vehicle and is raised again by the
+        drive loop, see `raise_trigger_error`.
+        '''
+        event = record.event
+        if self.tracer is not None:
+            self.tracer.name_thread('{} trigger'.format(record.name))
+        try:
+            while True:
+                event.wait()
+                if not self.on:
+                    break
+                event.clear()
+                if self.profiler or self.tracer:
+                    self.run_part_profiled(record)
                 else:
-                    outputs = p.run(*inputs)
+                    self.run_part(record)
+        except Exception as e:
+            print('Triggered part {} failed, stopping the vehicle: {!r}'.format(record.name, e))
+            self.trigger_error = e
+            self.on = False
+
+    def raise_trigger_error(self):
+        if self.trigger_error is not None:
+            error, self.trigger_error = self.trigger_error, None
+            raise error
+
+
+    def run_part(self, record):
+        '''
+        run one part: read its inputs, call it and save its outputs
+        '''
+        mem = self.mem
+
+        #don't run if there is a run condition that is False
+        if record.condition_slot is not None and not mem.get_slot(record.condition_slot):
+            return
+
+        if record.skip_unchanged:
+            seqs = mem.get_seqs(record.input_slots)
+            if seqs == record.last_seqs:
+                return
+            record.last_seqs = seqs
+
+        outputs = record.run(*mem.get_slots(record.input_slots))
+        if record.counts_updates:
+            outputs = self.check_fresh(record, outputs)
+
+        if outputs is not None:
+            if record.output_slot is not None:
+                mem.put_slot(record.output_slot, outputs)
+            elif record.output_slots:
+                mem.put_slots(record.output_slots, outputs)
+
+
+    def run_part_profiled(self, record):
+        '''
+        run_part timing the memory get, the call and the memory put for the
+        profiler and the tracer
+        '''
+        mem = self.mem
+        profiler = self.profiler
+        tracer = self.tracer
+        t0 = time.perf_counter()
+
+        if record.condition_slot is not None and not mem.get_slot(record.condition_slot):
+            return
+
+        if record.skip_unchanged:
+            seqs = mem.get_seqs(record.input_slots)
+            if seqs == record.last_seqs:
+                return
+            record.last_seqs = seqs
+
+        inputs = mem.get_slots(record.input_slots)
+        t1 = time.perf_counter()
+
+        outputs = record.run(*inputs)
+        if record.counts_updates:
+            outputs = self.check_fresh(record, outputs)
+        t2 = time.perf_counter()
+
+        if outputs is not None:
+            if record.output_slot is not None:
+                mem.put_slot(record.output_slot, outputs)
+            elif record.output_slots:
+                mem.put_slots(record.output_slots, outputs)
+        t3 = time.perf_counter()
+
+        if profiler:
+            profiler.record(record.name, 'get', t1 - t0)
+            profiler.record(record.name, 'run', t2 - t1)
+            profiler.record(record.name, 'put', t3 - t2)
+        if tracer:
+            tracer.span('get', 'memory', t0, t1, {'part': record.name, 'channels': record.inputs})
+            tracer.span(record.name, 'part', t1, t2)
+            tracer.span('put', 'memory', t2, t3, {'part': record.name, 'channels': record.outputs})
+
+
+    def check_fresh(self, record, outputs):
+        '''
+        Track when a threaded part last returned a new value and replace
+        its outputs with the fallback once they are older than max_age.
+        A value is new when the part's update loop incremented its
+        update_count since the previous tick, whether the value changed or
+        not.
+        '''
+        now = time.monotonic()
+        count = record.part.update_count
+        fresh = count != record.last_count
+        if record.fresh_time is None:
+            #the age of a part that has not produced anything yet counts
+            #from its first call
+            record.fresh_time = now
+
+        if fresh:
+            if record.fresh_count:
+                interval = now - record.fresh_time
+                record.interval_sum += interval
+                if interval > record.interval_max:
+                    record.interval_max = interval
+            record.fresh_count += 1
+            record.fresh_time = now
+            record.last_count = count
+            return outputs
+
+        if record.max_age is not None and now - record.fresh_time > record.max_age:
+            record.stale_ticks += 1
+            if record.fallback is not None:
+                return record.fallback
+        return outputs
+
+
+    def freshness_stats(self):
+        '''
+        For every threaded part with an update_count: the number of new
+        values seen by the drive loop, the ticks it spent stale, the age of
+        its current value and the mean and max time between new values,
+        times in seconds.
+        '''
+        now = time.monotonic()
+        stats = {}
+        for record in self.records:
+            if not record.counts_updates:
+                continue
+            intervals = record.fresh_count - 1
+            stats[record.name] = {
+                'fresh': record.fresh_count,
+                'stale_ticks': record.stale_ticks,
+                'age': now - record.fresh_time if record.fresh_time is not None else None,
+                'interval_mean': record.interval_sum / intervals if intervals > 0 else None,
+                'interval_max': record.interval_max}
+        return stats
+
+
+    def register_metrics(self):
+        '''
+        publish the loop counters of the running drive loop
+        '''
+        clock = self.clock
+        metrics.counter('donkey_vehicle_loops_total',
+                        'Drive loops run').set_function(lambda: clock.ticks)
+        metrics.counter('donkey_vehicle_loop_overruns_total',
+                        'Drive loops that ended after their deadline').set_function(lambda: clock.overruns)
+        metrics.gauge('donkey_vehicle_loop_rate_hz',
+                      'Mean drive loop rate since the start').set_function(
+                          lambda: clock.stats()['rate_hz'])
 
-                #save the output to memory
-                if outputs is not None:
-                    self.mem.put(entry['outputs'], outputs)
 
-                    
+    def loop_stats(self):
+        '''
+        Loop counters and jitter of the running drive loop: ticks, overruns,
+        skipped ticks, measured rate and lateness of the ticks in seconds.
+        Returns None before the vehicle is started.
+        '''
+        if self.clock is None:
+            return None
+        return self.clock.stats()
+
+
+    def profile_report(self):
+        '''
+        Table of p50/p95/p99/max times of every part over the recent ticks.
+        Returns None if the vehicle was not created with profile=True.
+        '''
+        if self.profiler is None:
+            return None
+        return self.profiler.report()
 
-    def stop(self):
+
+    def stop(self, timeout=None):
+        '''
+        Stop the drive loop and shut down all the parts at the same time.
+        Returns the names of the parts that didn't finish their shutdown
+        within `timeout` seconds (the vehicle's shutdown_timeout by default).
+        '''
         print('Shutting down vehicle and its parts...')
-        for entry in self.parts:
+        self.on = False
+        if self.clock is not None:
+            self.clock.stop()
+        for record in self.triggered:
+            record.event.set()
+
+        timed_out = self.shutdown_parts(self.shutdown_timeout if timeout is None else timeout)
+        if timed_out:
+            print('Parts still shutting down after timeout: {}'.format(', '.join(timed_out)))
+        print('memory channels:', ', '.join(str(k) for k in self.mem.keys()))
+
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+        if self.clock is not None:
+            print('loop stats:', self.loop_stats())
+        for name, st in self.freshness_stats().items():
+            print('{} freshness: {}'.format(name, st))
+        if self.profiler:
+            print(self.profile_report())
+        if self.tracer:
+            print('trace saved to', self.tracer.save())
+        return timed_out
+
+
+    def shutdown_parts(self, timeout):
+        '''
+        call the shutdown method of every part on its own thread and return
+        the names of the parts whose shutdown is still running after timeout
+        '''
+        def shutdown(name, part):
             try:
-                entry['part'].shutdown()
+                part.shutdown()
             except Exception as e:
-                print(e)
-        print(self.mem.d)
+                print('{} shutdown failed: {}'.format(name, e))
+
+        threads = []
+        for entry in self.parts:
+            part = entry['part']
+            if not hasattr(part, 'shutdown'):
+                continue
+            t = Thread(target=shutdown, args=(entry['name'], part), daemon=True)
+            t.start()
+            threads.append((entry['name'], t))
+
+        deadline = time.monotonic() + timeout
+        for name, t in threads:
+            t.join(max(0.0, deadline - time.monotonic()))
+        return [name for name, t in threads if t.is_alive()]
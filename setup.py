@@ -26,6 +26,7 @@ setup(name='donkeycar',
     author='Will Roscoe',
     author_email='wroscoe@gmail.com',
     license='MIT',
+    python_requires='>=3.5',
     entry_points={
         'console_scripts': [
             'donkey=donkeycar.management.base:execute_from_command_line',
@@ -79,7 +80,6 @@ setup(name='donkeycar',
         # Specify the Python versions you support here. In particular, ensure
         # that you indicate whether you support Python 2, Python 3 or both.
 
-        'Programming Language :: Python :: 3.4',
         'Programming Language :: Python :: 3.5',
         'Programming Language :: Python :: 3.6',
     ],